@@ -0,0 +1,126 @@
+# vim:ts=4 sw=4 et:
+
+import json
+import time
+import sqlite3
+import threading
+
+#-------------------------------------------------------------------------------
+
+class MessageArchive:
+    # 取得したメッセージとリプライをチャンネルと ts で保存する
+    #  message.in_history: conversations_history で取得した (チャンネルに表示される) メッセージ
+    #  channel.oldest/latest: 履歴を取得済みの範囲
+    #  thread.fetched: スレッド全体を最後に取得した時刻
+    ARCHIVE_VERSION=1
+    SCHEMA= [
+        'CREATE TABLE IF NOT EXISTS message( channel TEXT, ts TEXT, ts_num REAL, thread_ts TEXT, in_history INTEGER, latest_reply REAL, data TEXT, PRIMARY KEY( channel, ts ) )',
+        'CREATE INDEX IF NOT EXISTS message_history ON message( channel, in_history, ts_num )',
+        'CREATE INDEX IF NOT EXISTS message_thread ON message( channel, thread_ts, ts_num )',
+        'CREATE TABLE IF NOT EXISTS channel( id TEXT PRIMARY KEY, oldest REAL, latest REAL )',
+        'CREATE TABLE IF NOT EXISTS meta( key TEXT PRIMARY KEY, value TEXT )',
+        'CREATE TABLE IF NOT EXISTS thread( channel TEXT, ts TEXT, fetched REAL, PRIMARY KEY( channel, ts ) )',
+    ]
+
+    def __init__( self, archive_file ):
+        self.archive_file= archive_file
+        self.lock= threading.Lock()
+        print( 'open', self.archive_file, flush=True )
+        self.conn= sqlite3.connect( self.archive_file, timeout=30.0, check_same_thread=False )
+        with self.lock, self.conn:
+            self.conn.execute( 'PRAGMA journal_mode=WAL' )
+            for sql in self.SCHEMA:
+                self.conn.execute( sql )
+            row= self.conn.execute( 'SELECT value FROM meta WHERE key=?', ('version',) ).fetchone()
+            if row is None or int(row[0]) != self.ARCHIVE_VERSION:
+                self.conn.execute( 'DELETE FROM message' )
+                self.conn.execute( 'DELETE FROM channel' )
+                self.conn.execute( 'DELETE FROM thread' )
+                self.conn.execute( 'INSERT OR REPLACE INTO meta( key, value ) VALUES( ?, ? )', ('version', str(self.ARCHIVE_VERSION)) )
+
+    def close( self ):
+        with self.lock:
+            self.conn.close()
+
+    #--------------------------------------------------------------------------
+
+    def get_channel_range( self, channel_id ):
+        with self.lock:
+            row= self.conn.execute( 'SELECT oldest, latest FROM channel WHERE id=?', (channel_id,) ).fetchone()
+        if row is None:
+            return  None
+        return  row[0],row[1]
+
+    def set_channel_range( self, channel_id, oldest, latest ):
+        with self.lock, self.conn:
+            self.conn.execute( 'INSERT OR REPLACE INTO channel( id, oldest, latest ) VALUES( ?, ?, ? )', (channel_id, oldest, latest) )
+
+    #--------------------------------------------------------------------------
+
+    def upsert_message( self, channel_id, message, in_history ):
+        ts= message.get( 'ts', '0' )
+        self.conn.execute( 'INSERT INTO message( channel, ts, ts_num, thread_ts, in_history, latest_reply, data ) VALUES( ?, ?, ?, ?, ?, ?, ? )'
+                ' ON CONFLICT( channel, ts ) DO UPDATE SET thread_ts=excluded.thread_ts, in_history=max( in_history, excluded.in_history ),'
+                ' latest_reply=excluded.latest_reply, data=excluded.data',
+                (channel_id, ts, float(ts), message.get( 'thread_ts', None ), in_history,
+                    float(message.get( 'latest_reply', '0' )), json.dumps( message, ensure_ascii=False )) )
+
+    def add_history( self, channel_id, messages, oldest, latest=None ):
+        # oldest ～ latest の履歴を保存し、範囲内で消えたメッセージを削除する
+        ts_set= set( message.get( 'ts', '0' ) for message in messages )
+        with self.lock, self.conn:
+            sql= 'SELECT ts FROM message WHERE channel=? AND in_history=1 AND ts_num>=?'
+            args= [channel_id, oldest]
+            if latest is not None:
+                sql+= ' AND ts_num<?'
+                args.append( latest )
+            for row in self.conn.execute( sql, args ).fetchall():
+                if row[0] not in ts_set:
+                    self.conn.execute( 'DELETE FROM message WHERE channel=? AND ts=?', (channel_id, row[0]) )
+            for message in messages:
+                self.upsert_message( channel_id, message, 1 )
+
+    def add_messages( self, channel_id, messages, in_history=0 ):
+        with self.lock, self.conn:
+            for message in messages:
+                self.upsert_message( channel_id, message, in_history )
+
+    def get_history( self, channel_id, oldest ):
+        # 新しい順
+        with self.lock:
+            rows= self.conn.execute( 'SELECT data FROM message WHERE channel=? AND in_history=1 AND ts_num>=? ORDER BY ts_num DESC', (channel_id, oldest) ).fetchall()
+        return  [json.loads( row[0] ) for row in rows]
+
+    def get_open_threads( self, channel_id, oldest, open_ts ):
+        # oldest 以降に投稿され、open_ts 以降にリプライのあるスレッド
+        with self.lock:
+            rows= self.conn.execute( 'SELECT ts FROM message WHERE channel=? AND in_history=1 AND ts_num>=? AND latest_reply>=? ORDER BY ts_num', (channel_id, oldest, open_ts) ).fetchall()
+        return  [row[0] for row in rows]
+
+    #--------------------------------------------------------------------------
+
+    def get_replies( self, channel_id, thread_ts ):
+        # 親メッセージを先頭に古い順
+        with self.lock:
+            rows= self.conn.execute( 'SELECT data FROM message WHERE channel=? AND (thread_ts=? OR ts=?) ORDER BY ts<>?, ts_num', (channel_id, thread_ts, thread_ts, thread_ts) ).fetchall()
+        return  [json.loads( row[0] ) for row in rows]
+
+    def get_replies_time( self, channel_id, thread_ts ):
+        # set_replies で最後にスレッド全体を保存した時刻  なければ 0
+        with self.lock:
+            row= self.conn.execute( 'SELECT fetched FROM thread WHERE channel=? AND ts=?', (channel_id, thread_ts) ).fetchone()
+        if row is None:
+            return  0.0
+        return  row[0]
+
+    def set_replies( self, channel_id, thread_ts, replies ):
+        # スレッド全体を置き換える (消えたリプライは削除)
+        ts_set= set( message.get( 'ts', '0' ) for message in replies )
+        with self.lock, self.conn:
+            self.conn.execute( 'INSERT OR REPLACE INTO thread( channel, ts, fetched ) VALUES( ?, ?, ? )', (channel_id, thread_ts, time.time()) )
+            for row in self.conn.execute( 'SELECT ts FROM message WHERE channel=? AND thread_ts=? AND ts<>? AND in_history=0', (channel_id, thread_ts, thread_ts) ).fetchall():
+                if row[0] not in ts_set:
+                    self.conn.execute( 'DELETE FROM message WHERE channel=? AND ts=?', (channel_id, row[0]) )
+            for message in replies:
+                self.upsert_message( channel_id, message, 0 )
+
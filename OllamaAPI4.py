@@ -5,10 +5,19 @@ import sys
 import os
 import re
 import json
+import asyncio
 import requests
 import base64
 import time
+import random
+import queue
+import threading
 import datetime
+import contextlib
+try:
+    import aiohttp
+except ImportError:
+    aiohttp= None
 
 #------------------------------------------------------------------------------
 
@@ -85,10 +94,19 @@ class ExecTime:
 class OllamaOptions(OptionBase):
     def __init__( self, **args ):
         super().__init__()
-        self.base_url= os.environ.get('OLLAMA_HOST', 'http://localhost:11434' )
+        self.base_url= os.environ.get('OLLAMA_HOST', 'http://localhost:11434' )    # list または ',' 区切りで複数指定
         self.provider= 'ollama2'
         self.system_role= 'system' # or developer
-        self.timeout= 600
+        self.timeout= 600           # read timeout
+        self.connect_timeout= 10
+        self.pool_size= 4           # 同時リクエスト数に合わせる
+        self.max_fail= 2            # 連続で失敗したらホストを外す
+        self.probe_interval= 30     # 外したホストを確認する間隔 (秒)
+        self.max_retry= 3           # 一時的なエラーの再試行回数
+        self.retry_wait= 2.0        # 再試行の待ち時間 (jitter 付きで倍々に増やす)
+        self.retry_max_wait= 60.0
+        self.breaker_threshold= 5   # 連続で失敗したら breaker_cooldown 秒の間は呼び出さない (0 で無効)
+        self.breaker_cooldown= 60
         self.model= 'qwen3:8b'
         self.num_ctx= 8192
         self.temperature= -1.0
@@ -98,10 +116,308 @@ class OllamaOptions(OptionBase):
         self.remove_think= True
         self.debug_echo= False
         self.tools= None
+        self.keep_alive= None       # '30m', -1 など  None ならサーバーの既定値
+        self.streaming= False
+        self.max_output_chars= 0    # streaming 時にこの文字数を超えたら打ち切る (0 で無制限)
         self.apply_params( args )
 
 #------------------------------------------------------------------------------
 
+class ThinkFilter:
+    # streaming 出力から <think>～</think> を逐次取り除く
+    #  タグが chunk の境目で分かれても良いように、タグの途中かもしれない末尾と改行は保留する
+    OPEN_TAG= '<think>'
+    CLOSE_TAG= '</think>'
+
+    def __init__( self ):
+        self.buffer= ''
+        self.in_think= False
+        self.skip_newline= False
+        self.held_newline= ''
+
+    def get_partial_length( self, text, tag ):
+        for length in range( min( len(text), len(tag)-1 ), 0, -1 ):
+            if text.endswith( tag[:length] ):
+                return  length
+        return  0
+
+    def feed( self, text ):
+        self.buffer+= text
+        output= ''
+        while True:
+            if self.in_think:
+                pos= self.buffer.find( self.CLOSE_TAG )
+                if pos < 0:
+                    break
+                self.buffer= self.buffer[pos+len(self.CLOSE_TAG):]
+                self.in_think= False
+                self.skip_newline= True
+                continue
+            if self.skip_newline:
+                self.buffer= self.buffer.lstrip( '\n' )
+                if self.buffer == '':
+                    break
+                self.skip_newline= False
+            pos= self.buffer.find( self.OPEN_TAG )
+            if pos >= 0:
+                # 直前の改行は閉じなかった場合に戻すので残しておく
+                text= self.buffer[:pos]
+                output+= text.rstrip( '\n' )
+                self.held_newline= text[len(text.rstrip( '\n' )):]
+                self.buffer= self.buffer[pos+len(self.OPEN_TAG):]
+                self.in_think= True
+                continue
+            end= len(self.buffer) - self.get_partial_length( self.buffer, self.OPEN_TAG )
+            while end > 0 and self.buffer[end-1] == '\n':
+                end-= 1
+            output+= self.buffer[:end]
+            self.buffer= self.buffer[end:]
+            break
+        return  output
+
+    def flush( self ):
+        # 閉じていない <think> は remove_think_tag と同じくそのまま残す
+        output= self.buffer
+        if self.in_think:
+            output= self.held_newline + self.OPEN_TAG + output
+        self.buffer= ''
+        self.in_think= False
+        self.held_newline= ''
+        return  output
+
+#------------------------------------------------------------------------------
+
+class StreamDecoder:
+    # Ollama の streaming 応答を 1 行ずつ decode してまとめる (sync/async で共用)
+    #  callback が False を返すか max_output_chars を超えたら打ち切る
+    def __init__( self, api, start_time, callback= None ):
+        self.api= api
+        self.start_time= start_time
+        self.callback= callback
+        self.data= { 'message': { 'role': '', 'content': '' }, 'done': True }
+        self.thinking= ''
+        self.tools= []
+        self.output= ''
+        self.think_filter= None
+        if api.options.remove_think:
+            self.think_filter= ThinkFilter()
+        self.first_token= True
+        self.stopped= False
+
+    def decode_line( self, line ):
+        # 終了したら True
+        line= line.strip()
+        if not line:
+            return  False
+        data= json.loads( line )
+        self.data= data
+        message= data['message']
+        delta= message.get( 'content', '' )
+        if 'thinking' in message:
+            self.thinking+= message['thinking']
+        if 'tool_calls' in message:
+            self.tools.extend( message['tool_calls'] )
+        if self.first_token and (delta != '' or message.get( 'thinking', '' ) != ''):
+            self.api.add_ttft( time.perf_counter() - self.start_time )
+            self.first_token= False
+        if self.think_filter:
+            delta= self.think_filter.feed( delta )
+        self.output+= delta
+        if delta != '' and self.callback:
+            if self.callback( delta ) is False:
+                self.stopped= True
+        if self.api.options.max_output_chars > 0 and len(self.output) >= self.api.options.max_output_chars:
+            self.stopped= True
+        if data['done']:
+            return  True
+        if self.stopped:
+            print( 'streaming: stopped', flush=True )
+            data['done_reason']= 'stop'
+            return  True
+        return  False
+
+    def finish( self ):
+        if self.think_filter:
+            delta= self.think_filter.flush()
+            self.output+= delta
+            if delta != '' and self.callback and not self.stopped:
+                self.callback( delta )
+        message= self.data['message']
+        message['content']= self.output
+        if self.thinking != '':
+            message['thinking']= self.thinking
+        if message['role'] == '':
+            message['role']= 'assistant'
+        if self.tools != []:
+            message['tool_calls']= self.tools
+        return  self.data
+
+#------------------------------------------------------------------------------
+
+# 再試行する status code
+RETRY_STATUS_SET= set( [408, 429, 500, 502, 503, 504] )
+
+def get_error_status( e ):
+    # 通信時の例外を status code に置き換える
+    #  timeout は 504、接続できない場合は 503、それ以外 (応答の異常など) は 502
+    if isinstance( e, (requests.exceptions.Timeout, asyncio.TimeoutError) ):
+        return  504
+    if isinstance( e, requests.exceptions.ConnectionError ):
+        return  503
+    if aiohttp is not None and isinstance( e, aiohttp.ClientConnectionError ):
+        return  503
+    return  502
+
+class CircuitBreaker:
+    # 連続 threshold 回失敗したら cooldown 秒の間は呼び出さずに失敗を返す
+    #  cooldown 後は 1 件だけ通し、成功すれば元に戻す
+    def __init__( self, threshold, cooldown ):
+        self.threshold= threshold
+        self.cooldown= cooldown
+        self.fail_count= 0
+        self.open_time= 0.0
+        self.trial= False
+        self.lock= threading.Lock()
+
+    def is_open( self ):
+        with self.lock:
+            return  self.open_time != 0.0 and time.time() < self.open_time + self.cooldown
+
+    def allow( self ):
+        with self.lock:
+            if self.threshold <= 0 or self.open_time == 0.0:
+                return  True
+            if time.time() < self.open_time + self.cooldown or self.trial:
+                return  False
+            self.trial= True
+            return  True
+
+    def cancel( self ):
+        # 結果が出ないまま中断した場合
+        with self.lock:
+            self.trial= False
+
+    def record( self, success ):
+        with self.lock:
+            self.trial= False
+            if success:
+                if self.open_time != 0.0:
+                    print( 'circuit breaker: closed', flush=True )
+                self.fail_count= 0
+                self.open_time= 0.0
+                return
+            self.fail_count+= 1
+            if self.threshold > 0 and self.fail_count >= self.threshold:
+                if self.open_time == 0.0:
+                    print( 'circuit breaker: open (%d failures)' % self.fail_count, flush=True )
+                self.open_time= time.time()
+
+#------------------------------------------------------------------------------
+
+class Endpoint:
+    def __init__( self, url ):
+        self.url= url.strip().rstrip( '/' )
+        self.active= 0          # 処理中のリクエスト数
+        self.latency= 0.0       # 応答時間の移動平均
+        self.request_count= 0
+        self.error_count= 0
+        self.fail_count= 0      # 連続失敗回数
+        self.healthy= True
+        self.retry_time= 0.0
+        self.probing= False
+
+class Route:
+    def __init__( self, endpoint ):
+        self.endpoint= endpoint
+        self.url= endpoint.url
+        self.failed= False
+
+    def set_status( self, status_code ):
+        # 5xx はホスト側の障害として扱う
+        if status_code >= 500:
+            self.failed= True
+
+class EndpointRouter:
+    # 複数のホストから処理中のリクエストが最も少ないホストを選ぶ (同数なら応答の速い方)
+    #  連続 max_fail 回失敗したホストは外し、probe_interval ごとに probe_func で確認して戻す
+    def __init__( self, url_list, max_fail= 2, probe_interval= 30, probe_func= None ):
+        self.endpoint_list= [ Endpoint( url ) for url in url_list ]
+        self.max_fail= max_fail
+        self.probe_interval= probe_interval
+        self.probe_func= probe_func
+        self.lock= threading.Lock()
+
+    def acquire( self ):
+        now= time.time()
+        with self.lock:
+            for endpoint in self.endpoint_list:
+                if not endpoint.healthy and not endpoint.probing and now >= endpoint.retry_time and self.probe_func:
+                    endpoint.probing= True
+                    threading.Thread( target=self.probe, args=(endpoint,), daemon=True ).start()
+            candidate_list= [ endpoint for endpoint in self.endpoint_list if endpoint.healthy ]
+            if candidate_list == []:
+                # 全て外れている場合は次に復帰予定のホストに送る (1 台構成でも止まらない)
+                candidate_list= [ min( self.endpoint_list, key=lambda endpoint: endpoint.retry_time ) ]
+            endpoint= min( candidate_list, key=lambda endpoint: (endpoint.active, endpoint.latency) )
+            endpoint.active+= 1
+            endpoint.request_count+= 1
+            return  endpoint
+
+    def release( self, endpoint, latency, failed ):
+        with self.lock:
+            endpoint.active-= 1
+            if failed:
+                endpoint.error_count+= 1
+                endpoint.fail_count+= 1
+                if endpoint.fail_count >= self.max_fail:
+                    if endpoint.healthy:
+                        print( 'endpoint down:', endpoint.url, flush=True )
+                    endpoint.healthy= False
+                    endpoint.retry_time= time.time() + self.probe_interval
+            else:
+                endpoint.fail_count= 0
+                endpoint.healthy= True
+                if endpoint.latency == 0.0:
+                    endpoint.latency= latency
+                else:
+                    endpoint.latency= endpoint.latency * 0.8 + latency * 0.2
+
+    @contextlib.contextmanager
+    def route( self ):
+        # with 内で例外が出るか set_status で 5xx を受けたら失敗として数える
+        route= Route( self.acquire() )
+        start_time= time.perf_counter()
+        try:
+            yield  route
+        except Exception:
+            route.failed= True
+            raise
+        finally:
+            self.release( route.endpoint, time.perf_counter() - start_time, route.failed )
+
+    def probe( self, endpoint ):
+        try:
+            result= self.probe_func( endpoint.url )
+        except Exception:
+            result= False
+        with self.lock:
+            endpoint.probing= False
+            if result:
+                print( 'endpoint up:', endpoint.url, flush=True )
+                endpoint.healthy= True
+                endpoint.fail_count= 0
+            else:
+                endpoint.retry_time= time.time() + self.probe_interval
+
+    def get_stats_text( self ):
+        text= ''
+        with self.lock:
+            for endpoint in self.endpoint_list:
+                text+= '  %s: requests=%d errors=%d latency=%.2f sec%s\n' % (endpoint.url, endpoint.request_count, endpoint.error_count, endpoint.latency, '' if endpoint.healthy else ' (down)')
+        return  text
+
+#------------------------------------------------------------------------------
+
 def image_to_base64( image_data ):
     encoded_byte= base64.b64encode( image_data )
     return  encoded_byte.decode('utf-8')
@@ -116,10 +432,92 @@ def load_image( image_path ):
 class OllamaAPI:
     def __init__( self, options ):
         self.options= options
+        self.session= None
+        self.session_lock= threading.Lock()
+        self.stats_lock= threading.Lock()
+        self.ttft_list= []
+        self.eval_stats= { 'requests': 0, 'prompt_eval_count': 0, 'prompt_eval_duration': 0, 'eval_count': 0, 'eval_duration': 0 }
+        url_list= options.base_url
+        if isinstance( url_list, str ):
+            url_list= url_list.split( ',' )
+        self.router= EndpointRouter( url_list, options.max_fail, options.probe_interval, self.check_endpoint )
+        self.breaker= CircuitBreaker( options.breaker_threshold, options.breaker_cooldown )
+        self.headers_ollama= {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer %s' % os.environ.get('OLLAMA_API_KEY', os.environ.get( 'OPENAI_API_KEY', None) ),
+        }
+        self.headers_oai= {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer %s' % os.environ.get('OPENAI_API_KEY', 'lm-studio'),
+        }
+
+    def get_session( self ):
+        # keep-alive で接続を使い回す  pool_size 本まで同時に接続を保持する
+        with self.session_lock:
+            if self.session is None:
+                session= requests.Session()
+                adapter= requests.adapters.HTTPAdapter( pool_maxsize=max( 1, self.options.pool_size ) )
+                session.mount( 'http://', adapter )
+                session.mount( 'https://', adapter )
+                self.session= session
+            return  self.session
+
+    def close( self ):
+        with self.session_lock:
+            if self.session is not None:
+                self.session.close()
+                self.session= None
+
+    def post( self, api_url, headers, data, stream= False ):
+        return  self.get_session().post( api_url, headers=headers, data=data, stream=stream, timeout=(self.options.connect_timeout, self.options.timeout) )
+
+    def check_endpoint( self, url ):
+        # 外したホストが応答するか確認する
+        if self.options.provider.startswith( 'ollama' ):
+            api_url= url + '/api/version'
+            headers= self.headers_ollama
+        else:
+            api_url= url + '/v1/models'
+            headers= self.headers_oai
+        result= self.get_session().get( api_url, headers=headers, timeout=(self.options.connect_timeout, self.options.connect_timeout) )
+        return  result.status_code == 200
+
+    def add_ttft( self, sec ):
+        with self.stats_lock:
+            self.ttft_list.append( sec )
+
+    def get_ttft_stats( self ):
+        # (count, average, max) 秒
+        with self.stats_lock:
+            if self.ttft_list == []:
+                return  0,0.0,0.0
+            return  len(self.ttft_list),sum(self.ttft_list)/len(self.ttft_list),max(self.ttft_list)
+
+    def add_eval_stats( self, prompt_eval_count, eval_count, prompt_eval_duration= 0, eval_duration= 0 ):
+        # token 数と処理時間 (ns)  OpenAI 互換 API は時間が返らないので token 数のみ
+        with self.stats_lock:
+            self.eval_stats['requests']+= 1
+            self.eval_stats['prompt_eval_count']+= prompt_eval_count
+            self.eval_stats['eval_count']+= eval_count
+            self.eval_stats['prompt_eval_duration']+= prompt_eval_duration
+            self.eval_stats['eval_duration']+= eval_duration
+
+    def get_eval_stats( self ):
+        # add_eval_stats の合計に tokens/s を加えたもの
+        with self.stats_lock:
+            stats= dict( self.eval_stats )
+        stats['prompt_tokens_per_sec']= 0.0
+        if stats['prompt_eval_duration'] > 0:
+            stats['prompt_tokens_per_sec']= stats['prompt_eval_count'] * 1e9 / stats['prompt_eval_duration']
+        stats['eval_tokens_per_sec']= 0.0
+        if stats['eval_duration'] > 0:
+            stats['eval_tokens_per_sec']= stats['eval_count'] * 1e9 / stats['eval_duration']
+        return  stats
 
     #--------------------------------------------------------------------------
 
-    def chat_oai_1( self, message_list, tools ):
+    def make_oai_chat_request( self, message_list, tools, schema= None ):
+        # chat_oai_1 と AsyncOllamaAPI で共用する  (api_path, headers, data) を返す
         if self.options.debug_echo:
             print( '============= SendMessages' )
             for message in message_list:
@@ -132,8 +530,16 @@ class OllamaAPI:
         }
         if tools:
             params['tools']= tools.get_tools()
-        api_url= self.options.base_url + '/v1/chat/completions'
-        data= json.dumps( params )
+        if schema:
+            params['response_format']= {
+                'type': 'json_schema',
+                'json_schema': {
+                    'name': 'response',
+                    'strict': True,
+                    'schema': schema,
+                },
+            }
+        api_path= '/v1/chat/completions'
         if self.options.temperature >= 0.0:
             params['temperature']= self.options.temperature
         if self.options.top_k > 0:
@@ -148,28 +554,37 @@ class OllamaAPI:
                 if key != 'messages':
                     dump_params[key]= params[key]
             print( 'options=', dump_params, flush=True )
-        headers= {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer %s' % os.environ.get('OPENAI_API_KEY', 'lm-studio'),
-        }
+        return  api_path,self.headers_oai,json.dumps( params )
+
+    def decode_oai_chat( self, data ):
+        if self.options.debug_echo:
+            print( '============= Response' )
+            self.dump_response( data )
+            print( '=============' )
+        usage= data.get( 'usage', None )
+        if usage:
+            self.add_eval_stats( usage.get( 'prompt_tokens', 0 ), usage.get( 'completion_tokens', 0 ) )
+        return  data['choices'][0]['message']
+
+    def chat_oai_1( self, message_list, tools, schema= None ):
+        api_path,headers,data= self.make_oai_chat_request( message_list, tools, schema )
         try:
-            result= requests.post( api_url, headers=headers, data=data, timeout=self.options.timeout )
+            with self.router.route() as route:
+                result= self.post( route.url + api_path, headers, data )
+                route.set_status( result.status_code )
+                if result.status_code == 200:
+                    data= result.json()
         except Exception as e:
-            return  '',408
+            print( str(e), flush=True )
+            return  None,get_error_status( e )
         if result.status_code == 200:
-            data= result.json()
-            if self.options.debug_echo:
-                print( '============= Response' )
-                self.dump_response( data )
-                print( '=============' )
-            message= data['choices'][0]['message']
+            message= self.decode_oai_chat( data )
             return  message,result.status_code
         else:
             print( 'Error: %d' % result.status_code, flush=True )
         return  None,result.status_code
 
-    def chat_oai( self, text, system= None, image_data= None ):
-        tools= self.options.tools
+    def make_oai_message_list( self, text, system= None, image_data= None ):
         message_list= []
         message= {
                     'role': 'user',
@@ -177,7 +592,7 @@ class OllamaAPI:
                 }
         if image_data:
             b64_image= image_to_base64( image_data )
-            message['content']= {
+            message['content']= [
                 {
                     'type': 'input_text',
                     'text': text,
@@ -186,49 +601,69 @@ class OllamaAPI:
                     'type': 'input_image',
                     'image': f'data:mage/jpeg:base64,{b64_image}',
                 }
-            }
+            ]
         if system:
             message_list.append( {
                     'role': self.options.system_role,
                     'content': system,
                 } )
         message_list.append( message )
-        response= ''
-        status_code= 408
+        return  message_list
+
+    def chat_oai( self, text, system= None, image_data= None, schema= None ):
+        tools= self.options.tools
+        message_list= self.make_oai_message_list( text, system, image_data )
         while True:
-            message,status_code= self.chat_oai_1( message_list, tools )
+            message,status_code= self.chat_oai_1( message_list, tools, schema )
             if status_code != 200:
                 return  '',status_code
-            role= message['role']
-            if role == 'assistant':
-                if 'content' in message:
-                    assistant_content= message['content']
-                    message_list.append( message )
-                tool_calls= message.get( 'tool_calls', None )
-                if tool_calls:
-                    for tool_call in tool_calls:
-                        tool_call_id= tool_call['id']
-                        function= tool_call['function']
-                        func_name= function['name']
-                        arguments= json.loads(function['arguments'])
-                        data= ''
-                        if tools:
-                            data= tools.call_func( func_name, arguments )
-                        #if self.options.debug_echo:
-                        #    print( '**TOOL**', data, flush=True )
-                        message= {
-                                'role': 'tool',
-                                'name': func_name,
-                                'tool_call_id': tool_call_id,
-                                'content': data,
-                            }
-                        message_list.append( message )
-                    continue
-                response= message.get( 'content', '' )
-                if self.options.remove_think:
-                    response= self.remove_think_tag( response )
-            break
-        return  response,status_code
+            response= self.process_message( message, message_list, tools, True )
+            if response is not None:
+                return  response,status_code
+
+    #--------------------------------------------------------------------------
+
+    def process_message( self, message, message_list, tools, oai, streaming= False ):
+        # 1 回分の応答を処理する (sync/async で共用)
+        #  tool 呼び出しがあれば実行結果を message_list に積んで None を返す
+        #  それ以外は最終的な応答文字列を返す
+        role= message['role']
+        if role != 'assistant':
+            return  ''
+        if 'content' in message:
+            message_list.append( message )
+        tool_calls= message.get( 'tool_calls', None )
+        if tool_calls:
+            for tool_call in tool_calls:
+                function= tool_call['function']
+                func_name= function['name']
+                arguments= function['arguments']
+                if oai:
+                    arguments= json.loads( arguments )
+                data= ''
+                if tools:
+                    data= tools.call_func( func_name, arguments )
+                #if self.options.debug_echo:
+                #    print( '**TOOL**', data, flush=True )
+                if oai:
+                    message= {
+                            'role': 'tool',
+                            'name': func_name,
+                            'tool_call_id': tool_call['id'],
+                            'content': data,
+                        }
+                else:
+                    message= {
+                            'role': 'tool',
+                            'tool_name': func_name,
+                            'content': data,
+                        }
+                message_list.append( message )
+            return  None
+        response= message.get( 'content', '' )
+        if self.options.remove_think and not streaming:
+            response= self.remove_think_tag( response )
+        return  response
 
     #--------------------------------------------------------------------------
 
@@ -249,18 +684,17 @@ class OllamaAPI:
                     "image": f"data:mage/jpeg:base64,{b64_image}",
                 }
             }
-        api_url= self.options.base_url + '/v1/response'
         data= json.dumps( params )
-        headers= {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer %s' % os.environ.get('OPENAI_API_KEY', 'lm-studio'),
-        }
         try:
-            result= requests.post( api_url, headers=headers, data=data, timeout=self.options.timeout )
+            with self.router.route() as route:
+                result= self.post( route.url + '/v1/response', self.headers_oai, data )
+                route.set_status( result.status_code )
+                if result.status_code == 200:
+                    data= result.json()
         except Exception as e:
-            return  '',408
+            print( str(e), flush=True )
+            return  '',get_error_status( e )
         if result.status_code == 200:
-            data= result.json()
             response= data['output'][0]['content'][0]['text']
             if self.options.remove_think:
                 response= self.remove_think_tag( response )
@@ -271,7 +705,7 @@ class OllamaAPI:
 
     #--------------------------------------------------------------------------
 
-    def generate_ollama( self, text, system= None, image_data= None ):
+    def generate_ollama( self, text, system= None, image_data= None, schema= None ):
         params= {
             'model': self.options.model,
             'prompt': text,
@@ -281,14 +715,21 @@ class OllamaAPI:
             params['system']= system
         if image_data:
             params['images']= [ image_to_base64( image_data ) ]
-        api_url= self.options.base_url + '/api/generate'
+        if schema:
+            params['format']= schema
+        if self.options.keep_alive is not None:
+            params['keep_alive']= self.options.keep_alive
         data= json.dumps( params )
         try:
-            result= requests.post( api_url, headers={ 'Content-Type': 'application/json' }, data=data, timeout=self.options.timeout )
+            with self.router.route() as route:
+                result= self.post( route.url + '/api/generate', { 'Content-Type': 'application/json' }, data )
+                route.set_status( result.status_code )
+                if result.status_code == 200:
+                    data= result.json()
         except Exception as e:
-            return  '',408
+            print( str(e), flush=True )
+            return  '',get_error_status( e )
         if result.status_code == 200:
-            data= result.json()
             response= data['response']
             if self.options.remove_think:
                 response= self.remove_think_tag( response )
@@ -318,31 +759,17 @@ class OllamaAPI:
         ignore_set= set( ['message'] )
         self.dump_object( '+', response, ignore_set )
 
-    def decode_streaming( self, result ):
-        content= ''
-        thinking= ''
-        tools= []
-        for line in result.text.split( '\n' ):
-            data= json.loads( line )
-            message= data['message']
-            role= message['role']
-            content+= message['content']
-            if 'thinking' in message:
-                thinking+= message['thinking']
-            if 'tool_calls' in message:
-                tools.extend( message['tool_calls'] )
-            if data['done']:
+    def decode_streaming( self, result, start_time, callback= None ):
+        # 届いた行から順に decode し、本文の差分を callback に渡す
+        decoder= StreamDecoder( self, start_time, callback )
+        for line in result.iter_lines():
+            if decoder.decode_line( line ):
                 break
-        message['content']= content
-        if thinking != '':
-            message['thinking']= thinking
-        if message['role'] == '':
-            message['role']= 'assistant'
-        if tools != []:
-            message['tool_calls']= tools
-        return  data
+        result.close()
+        return  decoder.finish()
 
-    def chat_ollama_1( self, message_list, tools, streaming= False ):
+    def make_ollama_chat_request( self, message_list, tools, streaming= False, schema= None ):
+        # chat_ollama_1 と AsyncOllamaAPI で共用する  (api_path, headers, data) を返す
         if self.options.debug_echo:
             print( '============= SendMessages' )
             for message in message_list:
@@ -366,36 +793,49 @@ class OllamaAPI:
             params['options']['min_p']= self.options.min_p
         if tools:
             params['tools']= tools.get_tools()
-        api_url= self.options.base_url + '/api/chat'
-        data= json.dumps( params )
+        if schema:
+            # JSON schema で出力形式を指定する
+            params['format']= schema
+        if self.options.keep_alive is not None:
+            params['keep_alive']= self.options.keep_alive
+        api_path= '/api/chat'
         if self.options.debug_echo:
             print( 'options=', params['options'], flush=True )
-        headers= {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer %s' % os.environ.get('OLLAMA_API_KEY', os.environ.get( 'OPENAI_API_KEY', None) ),
-        }
+        return  api_path,self.headers_ollama,json.dumps( params )
+
+    def decode_ollama_chat( self, data ):
+        if self.options.debug_echo:
+            print( '============= Response' )
+            self.dump_response( data )
+            print( '=============' )
+        # streaming では最後の行に入っている
+        if 'eval_count' in data:
+            self.add_eval_stats( data.get( 'prompt_eval_count', 0 ), data['eval_count'], data.get( 'prompt_eval_duration', 0 ), data.get( 'eval_duration', 0 ) )
+        return  data['message']
+
+    def chat_ollama_1( self, message_list, tools, streaming= False, schema= None, callback= None ):
+        api_path,headers,data= self.make_ollama_chat_request( message_list, tools, streaming, schema )
+        start_time= time.perf_counter()
         try:
-            result= requests.post( api_url, headers=headers, data=data, timeout=self.options.timeout )
+            with self.router.route() as route:
+                result= self.post( route.url + api_path, headers, data, stream=streaming )
+                route.set_status( result.status_code )
+                if result.status_code == 200:
+                    if streaming:
+                        data= self.decode_streaming( result, start_time, callback )
+                    else:
+                        data= result.json()
         except Exception as e:
             print( str(e), flush=True )
-            return  None,408
+            return  None,get_error_status( e )
         if result.status_code == 200:
-            if streaming:
-                data= self.decode_streaming( result )
-            else:
-                data= result.json()
-            if self.options.debug_echo:
-                print( '============= Response' )
-                self.dump_response( data )
-                print( '=============' )
-            message= data['message']
+            message= self.decode_ollama_chat( data )
             return  message,result.status_code
         else:
             print( 'Error: %d' % result.status_code, flush=True )
         return  None,result.status_code
 
-    def generate_ollama_chat( self, text, system= None, image_data= None ):
-        tools= self.options.tools
+    def make_ollama_message_list( self, text, system= None, image_data= None ):
         message_list= []
         message= {
                     'role': 'user',
@@ -409,52 +849,129 @@ class OllamaAPI:
                     'content': system,
                 } )
         message_list.append( message )
-        response= ''
-        status_code= 408
+        return  message_list
+
+    def generate_ollama_chat( self, text, system= None, image_data= None, schema= None, callback= None ):
+        # callback を指定すると streaming で受信し、<think> を除いた差分を届いた順に渡す
+        tools= self.options.tools
+        message_list= self.make_ollama_message_list( text, system, image_data )
+        streaming= self.options.streaming or callback is not None
         while True:
-            message,status_code= self.chat_ollama_1( message_list, tools )
+            message,status_code= self.chat_ollama_1( message_list, tools, streaming, schema, callback )
             if status_code != 200:
                 return  '',status_code
-            role= message['role']
-            if role == 'assistant':
-                if 'content' in message:
-                    assistant_content= message['content']
-                    message_list.append( message )
-                tool_calls= message.get( 'tool_calls', None )
-                if tool_calls:
-                    for tool_call in tool_calls:
-                        function= tool_call['function']
-                        func_name= function['name']
-                        arguments= function['arguments']
-                        data= ''
-                        if tools:
-                            data= tools.call_func( func_name, arguments )
-                        #if self.options.debug_echo:
-                        #    print( '**TOOL**', data, flush=True )
-                        message= {
-                                'role': 'tool',
-                                'tool_name': func_name,
-                                'content': data,
-                            }
-                        message_list.append( message )
-                    continue
-                response= message.get( 'content', '' )
-                if self.options.remove_think:
-                    response= self.remove_think_tag( response )
-            break
-        return  response,status_code
+            response= self.process_message( message, message_list, tools, False, streaming )
+            if response is not None:
+                return  response,status_code
 
     #--------------------------------------------------------------------------
 
-    def generate( self, text, system= None, image_data= None ):
+    def make_preload_request( self ):
+        # prompt なしの generate でモデルだけを読み込む
+        #  num_ctx が異なると再読み込みになるので本番と同じ値を渡す
+        params= {
+            'model': self.options.model,
+            'options': {
+                'num_ctx': self.options.num_ctx,
+            },
+        }
+        if self.options.keep_alive is not None:
+            params['keep_alive']= self.options.keep_alive
+        return  '/api/generate',self.headers_ollama,json.dumps( params )
+
+    def preload( self ):
+        # 全てのホストで読み込む
+        if not self.options.provider.startswith( 'ollama' ):
+            return  False
+        api_path,headers,data= self.make_preload_request()
+        success= True
+        for endpoint in self.router.endpoint_list:
+            try:
+                result= self.post( endpoint.url + api_path, headers, data )
+            except Exception as e:
+                print( 'preload:', endpoint.url, str(e), flush=True )
+                success= False
+                continue
+            if result.status_code != 200:
+                print( 'preload Error: %s %d' % (endpoint.url, result.status_code), flush=True )
+                success= False
+        return  success
+
+    #--------------------------------------------------------------------------
+
+    def get_retry_wait( self, retry_count ):
+        # full jitter の指数バックオフ
+        return  random.uniform( 0, min( self.options.retry_max_wait, self.options.retry_wait * (2 ** retry_count) ) )
+
+    def generate( self, text, system= None, image_data= None, schema= None, callback= None ):
+        # schema を指定すると JSON schema に従った JSON 文字列を返す
+        # callback( text ) には出力の差分が届いた順に渡る  False を返すと生成を打ち切る
+        # 一時的なエラーは待ってから再試行する  出力を callback に渡し始めた後は再試行しない
+        if not self.breaker.allow():
+            return  '',503
+        output_state= [ False ]
+        def retry_callback( delta ):
+            output_state[0]= True
+            return  callback( delta )
+        retry_count= 0
+        try:
+            while True:
+                response,status_code= self.generate_1( text, system, image_data, schema, retry_callback if callback else None )
+                if status_code not in RETRY_STATUS_SET:
+                    self.breaker.record( True )
+                    return  response,status_code
+                if retry_count >= self.options.max_retry or output_state[0] or self.breaker.is_open():
+                    break
+                wait_time= self.get_retry_wait( retry_count )
+                retry_count+= 1
+                print( 'retry %d/%d after %.1f sec (status %d)' % (retry_count, self.options.max_retry, wait_time, status_code), flush=True )
+                time.sleep( wait_time )
+        except BaseException:
+            self.breaker.cancel()
+            raise
+        self.breaker.record( False )
+        return  response,status_code
+
+    def generate_1( self, text, system= None, image_data= None, schema= None, callback= None ):
         if self.options.provider.startswith( 'ollama' ):
-            return  self.generate_ollama_chat( text, system, image_data )
+            return  self.generate_ollama_chat( text, system, image_data, schema, callback )
         elif self.options.provider == 'lmstudio':
-            return  self.chat_oai( text, system, image_data )
+            # OpenAI 互換 API は streaming 未対応なので完了後にまとめて渡す
+            response,status_code= self.chat_oai( text, system, image_data, schema )
+            if callback and response != '':
+                callback( response )
+            return  response,status_code
         #elif self.options.provider == 'openai':
         #    return  self.generate_oai( text, system, image_data )
         return  '',400
 
+    def generate_iter( self, text, system= None, image_data= None, schema= None ):
+        # 出力の差分を届いた順に返すジェネレータ  status_code は StopIteration.value
+        #  途中で close すると生成を打ち切る
+        output_queue= queue.Queue()
+        stop_event= threading.Event()
+        result= [ '', 500 ]
+        def callback( delta ):
+            output_queue.put( delta )
+            return  not stop_event.is_set()
+        def worker():
+            try:
+                result[:]= self.generate( text, system, image_data, schema, callback )
+            finally:
+                output_queue.put( None )
+        thread= threading.Thread( target=worker, daemon=True )
+        thread.start()
+        try:
+            while True:
+                delta= output_queue.get()
+                if delta is None:
+                    break
+                yield  delta
+        finally:
+            stop_event.set()
+            thread.join()
+        return  result[1]
+
     #--------------------------------------------------------------------------
 
     def remove_think_tag( self, response ):
@@ -466,11 +983,188 @@ class OllamaAPI:
 
 #------------------------------------------------------------------------------
 
+class AsyncOllamaAPI(OllamaAPI):
+    # asyncio 版  リクエストの組み立てと応答の解析は OllamaAPI と共用する
+    #  接続は aiohttp の ClientSession で pool_size 本まで使い回す
+    #  全体の時間制限やキャンセルは asyncio.wait_for / Task.cancel で行う
+    def __init__( self, options ):
+        super().__init__( options )
+        self.async_session= None
+
+    async def __aenter__( self ):
+        return  self
+
+    async def __aexit__( self, *arg ):
+        await self.aclose()
+        return  False
+
+    def get_async_session( self ):
+        if aiohttp is None:
+            raise RuntimeError( 'AsyncOllamaAPI requires aiohttp' )
+        if self.async_session is None or self.async_session.closed:
+            connector= aiohttp.TCPConnector( limit=max( 1, self.options.pool_size ) )
+            timeout= aiohttp.ClientTimeout( sock_connect=self.options.connect_timeout, sock_read=self.options.timeout )
+            self.async_session= aiohttp.ClientSession( connector=connector, timeout=timeout )
+        return  self.async_session
+
+    async def aclose( self ):
+        if self.async_session is not None:
+            await self.async_session.close()
+            self.async_session= None
+
+    #--------------------------------------------------------------------------
+
+    async def chat_oai_1( self, message_list, tools, schema= None ):
+        api_path,headers,data= self.make_oai_chat_request( message_list, tools, schema )
+        session= self.get_async_session()
+        try:
+            with self.router.route() as route:
+                async with session.post( route.url + api_path, headers=headers, data=data ) as result:
+                    route.set_status( result.status )
+                    if result.status != 200:
+                        print( 'Error: %d' % result.status, flush=True )
+                        return  None,result.status
+                    data= await result.json( content_type=None )
+        except Exception as e:
+            # 同期版と同じく、壊れた応答 (streaming の不正な行など) も status code にする
+            print( str(e), flush=True )
+            return  None,get_error_status( e )
+        return  self.decode_oai_chat( data ),200
+
+    async def chat_oai( self, text, system= None, image_data= None, schema= None ):
+        tools= self.options.tools
+        message_list= self.make_oai_message_list( text, system, image_data )
+        while True:
+            message,status_code= await self.chat_oai_1( message_list, tools, schema )
+            if status_code != 200:
+                return  '',status_code
+            response= self.process_message( message, message_list, tools, True )
+            if response is not None:
+                return  response,status_code
+
+    async def chat_ollama_1( self, message_list, tools, streaming= False, schema= None, callback= None ):
+        api_path,headers,data= self.make_ollama_chat_request( message_list, tools, streaming, schema )
+        start_time= time.perf_counter()
+        session= self.get_async_session()
+        try:
+            with self.router.route() as route:
+                async with session.post( route.url + api_path, headers=headers, data=data ) as result:
+                    route.set_status( result.status )
+                    if result.status != 200:
+                        print( 'Error: %d' % result.status, flush=True )
+                        return  None,result.status
+                    if streaming:
+                        decoder= StreamDecoder( self, start_time, callback )
+                        async for line in result.content:
+                            if decoder.decode_line( line ):
+                                break
+                        data= decoder.finish()
+                    else:
+                        data= await result.json( content_type=None )
+        except Exception as e:
+            # 同期版と同じく、壊れた応答 (streaming の不正な行など) も status code にする
+            print( str(e), flush=True )
+            return  None,get_error_status( e )
+        return  self.decode_ollama_chat( data ),200
+
+    async def generate_ollama_chat( self, text, system= None, image_data= None, schema= None, callback= None ):
+        tools= self.options.tools
+        message_list= self.make_ollama_message_list( text, system, image_data )
+        streaming= self.options.streaming or callback is not None
+        while True:
+            message,status_code= await self.chat_ollama_1( message_list, tools, streaming, schema, callback )
+            if status_code != 200:
+                return  '',status_code
+            response= self.process_message( message, message_list, tools, False, streaming )
+            if response is not None:
+                return  response,status_code
+
+    #--------------------------------------------------------------------------
+
+    async def preload( self ):
+        if not self.options.provider.startswith( 'ollama' ):
+            return  False
+        api_path,headers,data= self.make_preload_request()
+        session= self.get_async_session()
+        async def preload_1( endpoint ):
+            try:
+                async with session.post( endpoint.url + api_path, headers=headers, data=data ) as result:
+                    if result.status != 200:
+                        print( 'preload Error: %s %d' % (endpoint.url, result.status), flush=True )
+                        return  False
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print( 'preload:', endpoint.url, str(e), flush=True )
+                return  False
+            return  True
+        result_list= await asyncio.gather( *[ preload_1( endpoint ) for endpoint in self.router.endpoint_list ] )
+        return  all( result_list )
+
+    async def generate( self, text, system= None, image_data= None, schema= None, callback= None ):
+        if not self.breaker.allow():
+            return  '',503
+        output_state= [ False ]
+        def retry_callback( delta ):
+            output_state[0]= True
+            return  callback( delta )
+        retry_count= 0
+        try:
+            while True:
+                response,status_code= await self.generate_1( text, system, image_data, schema, retry_callback if callback else None )
+                if status_code not in RETRY_STATUS_SET:
+                    self.breaker.record( True )
+                    return  response,status_code
+                if retry_count >= self.options.max_retry or output_state[0] or self.breaker.is_open():
+                    break
+                wait_time= self.get_retry_wait( retry_count )
+                retry_count+= 1
+                print( 'retry %d/%d after %.1f sec (status %d)' % (retry_count, self.options.max_retry, wait_time, status_code), flush=True )
+                await asyncio.sleep( wait_time )
+        except BaseException:
+            self.breaker.cancel()
+            raise
+        self.breaker.record( False )
+        return  response,status_code
+
+    async def generate_1( self, text, system= None, image_data= None, schema= None, callback= None ):
+        if self.options.provider.startswith( 'ollama' ):
+            return  await self.generate_ollama_chat( text, system, image_data, schema, callback )
+        elif self.options.provider == 'lmstudio':
+            response,status_code= await self.chat_oai( text, system, image_data, schema )
+            if callback and response != '':
+                callback( response )
+            return  response,status_code
+        return  '',400
+
+    async def generate_iter( self, text, system= None, image_data= None, schema= None ):
+        # 出力の差分を届いた順に返す async ジェネレータ  途中で抜けると生成を打ち切る
+        output_queue= asyncio.Queue()
+        async def worker():
+            try:
+                return  await self.generate( text, system, image_data, schema, output_queue.put_nowait )
+            finally:
+                output_queue.put_nowait( None )
+        task= asyncio.ensure_future( worker() )
+        try:
+            while True:
+                delta= await output_queue.get()
+                if delta is None:
+                    break
+                yield  delta
+        finally:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+#------------------------------------------------------------------------------
+
 def usage():
     print( 'OllamaAPI v4.25' )
     print( 'usage: OllamaAPI4 [<options>] [<message..>]' )
     print( 'options:' )
-    print( '  --host <base_url>' )
+    print( '  --host <base_url>            host1,host2,... for multiple hosts' )
     print( '  --model <model_name>' )
     print( '  --provider <provider>        # ollama2, openai, lmstudio' )
     print( '  --image <image_file>' )
@@ -478,6 +1172,11 @@ def usage():
     print( '  --output <save_file.txt>' )
     print( '  --num_ctx <num_ctx>          default 8192' )
     print( '  --temperature <temperature>' )
+    print( '  --timeout <sec>              read timeout, default 600' )
+    print( '  --connect_timeout <sec>      default 10' )
+    print( '  --pool_size <size>           default 4' )
+    print( '  --keep_alive <duration>      30m, -1, ...' )
+    print( '  --stream                     print output as it arrives' )
     print( '  --debug' )
     sys.exit( 0 )
 
@@ -506,6 +1205,18 @@ def main( argv ):
                 ai= options.set_int( ai, argv, 'num_ctx' )
             elif arg == '--temperature':
                 ai= options.set_float( ai, argv, 'temperature' )
+            elif arg == '--timeout':
+                ai= options.set_float( ai, argv, 'timeout' )
+            elif arg == '--connect_timeout':
+                ai= options.set_float( ai, argv, 'connect_timeout' )
+            elif arg == '--pool_size':
+                ai= options.set_int( ai, argv, 'pool_size' )
+            elif arg == '--keep_alive':
+                ai= options.set_str( ai, argv, 'keep_alive' )
+                if re.fullmatch( r'-?\d+', str(options.keep_alive) ):
+                    options.keep_alive= int(options.keep_alive)
+            elif arg == '--stream':
+                options.streaming= True
             elif arg == '--debug':
                 options.debug_echo= True
             else:
@@ -529,11 +1240,25 @@ def main( argv ):
                 return  1
         input_text= ' '.join( text_list )
         print( 'prompt:', input_text )
-        output_text,status_code= api.generate( input_text, image_data )
-        print( 'output:', output_text )
+        if options.streaming:
+            print( 'output: ', end='', flush=True )
+            def callback( delta ):
+                print( delta, end='', flush=True )
+            output_text,status_code= api.generate( input_text, image_data=image_data, callback=callback )
+            print()
+            count,average,max_time= api.get_ttft_stats()
+            if count:
+                print( 'ttft: %.2f sec' % average )
+        else:
+            output_text,status_code= api.generate( input_text, image_data=image_data )
+            print( 'output:', output_text )
+        stats= api.get_eval_stats()
+        if stats['eval_duration'] > 0:
+            print( 'eval: %.1f tokens/s, prompt: %.1f tokens/s' % (stats['eval_tokens_per_sec'], stats['prompt_tokens_per_sec']) )
         if options.output:
             with open( options.output, 'w', encoding='utf-8' ) as fo:
                 fo.write( output_text )
+        api.close()
     else:
         usage()
     return  0
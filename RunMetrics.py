@@ -0,0 +1,187 @@
+# vim:ts=4 sw=4 et:
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+#-------------------------------------------------------------------------------
+
+class Histogram:
+    # 秒単位の latency 用  buckets は上限値 (Prometheus の le)
+    BUCKETS= (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+    def __init__( self, buckets=None ):
+        self.buckets= buckets or self.BUCKETS
+        self.bucket_count= [0] * len(self.buckets)
+        self.count= 0
+        self.sum= 0.0
+        self.max= 0.0
+
+    def observe( self, value ):
+        for index,limit in enumerate(self.buckets):
+            if value <= limit:
+                self.bucket_count[index]+= 1
+                break
+        self.count+= 1
+        self.sum+= value
+        self.max= max( self.max, value )
+
+    def get_cumulative( self ):
+        # (le, 累積件数) のリスト  最後は +Inf
+        result= []
+        total= 0
+        for limit,count in zip( self.buckets, self.bucket_count ):
+            total+= count
+            result.append( (limit, total) )
+        result.append( ('+Inf', self.count) )
+        return  result
+
+    def get_quantile( self, rate ):
+        # bucket の上限で近似する
+        if self.count == 0:
+            return  0.0
+        for limit,total in self.get_cumulative():
+            if total >= self.count * rate:
+                return  self.max if limit == '+Inf' else min( limit, self.max )
+        return  self.max
+
+    def get_report( self ):
+        return  {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'p50': self.get_quantile( 0.5 ),
+            'p95': self.get_quantile( 0.95 ),
+            'max': self.max,
+            'buckets': { str(limit): total for limit,total in self.get_cumulative() },
+        }
+
+#-------------------------------------------------------------------------------
+
+class RunMetrics:
+    # 1 回の実行の計測値を集める
+    #  counter: add() で加算、gauge: set() で上書き、histogram: observe() で分布
+    #  名前とラベル (key=value) の組ごとに値を持ち、JSON と Prometheus の textfile で書き出す
+    PREFIX= 'slack_summary_'
+
+    def __init__( self ):
+        self.lock= threading.Lock()
+        self.type_map= {}
+        self.value_map= {}
+        self.stage_start_map= {}
+        self.start_time= time.time()
+
+    def get_key( self, name, metric_type, labels ):
+        self.type_map.setdefault( name, metric_type )
+        return  (name, tuple( sorted( labels.items() ) ))
+
+    def add( self, name, value=1, **labels ):
+        with self.lock:
+            key= self.get_key( name, 'counter', labels )
+            self.value_map[key]= self.value_map.get( key, 0 ) + value
+
+    def set( self, name, value, **labels ):
+        with self.lock:
+            self.value_map[self.get_key( name, 'gauge', labels )]= value
+
+    def observe( self, name, value, **labels ):
+        with self.lock:
+            key= self.get_key( name, 'histogram', labels )
+            histogram= self.value_map.get( key, None )
+            if histogram is None:
+                histogram= Histogram()
+                self.value_map[key]= histogram
+            histogram.observe( value )
+
+    @contextlib.contextmanager
+    def stage( self, name ):
+        # 段階ごとの処理時間
+        #  stage_seconds_total: 並列に実行された分をそれぞれ加算した時間
+        #  stage_wall_seconds: 最初の開始から最後の終了までの経過時間
+        start_time= time.perf_counter()
+        with self.lock:
+            self.stage_start_map.setdefault( name, start_time )
+        try:
+            yield
+        finally:
+            end_time= time.perf_counter()
+            self.add( 'stage_seconds_total', end_time - start_time, stage=name )
+            self.add( 'stage_calls_total', 1, stage=name )
+            with self.lock:
+                key= self.get_key( 'stage_wall_seconds', 'gauge', { 'stage': name } )
+                self.value_map[key]= max( self.value_map.get( key, 0.0 ), end_time - self.stage_start_map[name] )
+
+    def get( self, name, **labels ):
+        with self.lock:
+            return  self.value_map.get( (name, tuple( sorted( labels.items() ) )), None )
+
+    def get_stage_text( self ):
+        line_list= []
+        with self.lock:
+            for (name,labels),value in sorted( self.value_map.items() ):
+                if name == 'stage_seconds_total':
+                    calls= self.value_map.get( ('stage_calls_total', labels), 0 )
+                    wall= self.value_map.get( ('stage_wall_seconds', labels), 0.0 )
+                    line_list.append( '  %s: wall %.2f sec, busy %.2f sec (%d)\n' % (dict(labels)['stage'], wall, value, calls) )
+        return  ''.join( line_list )
+
+    #--------------------------------------------------------------------------
+
+    def get_report( self, info={} ):
+        # { name: value } または { name: { 'key=value,...': value } }
+        report= dict( info )
+        report['start_time']= self.start_time
+        with self.lock:
+            for (name,labels),value in sorted( self.value_map.items() ):
+                if isinstance( value, Histogram ):
+                    value= value.get_report()
+                if labels == ():
+                    report[name]= value
+                else:
+                    report.setdefault( name, {} )[','.join( '%s=%s' % label for label in labels )]= value
+        return  report
+
+    def save_json( self, file_name, info={} ):
+        self.write_file( file_name, json.dumps( self.get_report( info ), indent=4, ensure_ascii=False ) + '\n' )
+
+    def format_labels( self, labels, extra=() ):
+        label_list= ['%s="%s"' % (key, str(value).replace( '\\', '\\\\' ).replace( '"', '\\"' )) for key,value in labels + extra]
+        if label_list == []:
+            return  ''
+        return  '{' + ','.join( label_list ) + '}'
+
+    def get_prometheus_text( self ):
+        # https://prometheus.io/docs/instrumenting/exposition_formats/
+        line_list= []
+        with self.lock:
+            name_map= {}
+            for (name,labels),value in sorted( self.value_map.items() ):
+                name_map.setdefault( name, [] ).append( (labels, value) )
+            for name in name_map:
+                metric_name= self.PREFIX + name
+                line_list.append( '# TYPE %s %s' % (metric_name, self.type_map[name]) )
+                for labels,value in name_map[name]:
+                    if isinstance( value, Histogram ):
+                        for limit,total in value.get_cumulative():
+                            line_list.append( '%s_bucket%s %d' % (metric_name, self.format_labels( labels, (('le', limit),) ), total) )
+                        line_list.append( '%s_sum%s %f' % (metric_name, self.format_labels( labels ), value.sum) )
+                        line_list.append( '%s_count%s %d' % (metric_name, self.format_labels( labels ), value.count) )
+                    else:
+                        line_list.append( '%s%s %s' % (metric_name, self.format_labels( labels ), float(value)) )
+        line_list.append( '# TYPE %srun_timestamp_seconds gauge' % self.PREFIX )
+        line_list.append( '%srun_timestamp_seconds %f' % (self.PREFIX, self.start_time) )
+        return  '\n'.join( line_list ) + '\n'
+
+    def save_prometheus( self, file_name ):
+        # node_exporter の textfile collector が書き込み途中を読まないように置き換える
+        self.write_file( file_name, self.get_prometheus_text() )
+
+    def write_file( self, file_name, text ):
+        temp_file= file_name + '.tmp'
+        with open( temp_file, 'w', encoding='utf-8' ) as fo:
+            fo.write( text )
+        os.replace( temp_file, file_name )
+        print( 'save', file_name, flush=True )
+
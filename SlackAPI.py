@@ -5,6 +5,8 @@ import os
 import sys
 import time
 import json
+import sqlite3
+import threading
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
@@ -21,7 +23,13 @@ from slack_sdk.errors import SlackApiError
 
 #-------------------------------------------------------------------------------
 
+save_lock= threading.Lock()
+
 def save_json( file_name, message_obj ):
+    with save_lock:
+        save_json_1( file_name, message_obj )
+
+def save_json_1( file_name, message_obj ):
     if os.path.exists( file_name ):
         file_name_bak= file_name+'.bak'
         if os.path.exists( file_name_bak ):
@@ -38,35 +46,442 @@ def load_json( file_name ):
 
 #-------------------------------------------------------------------------------
 
-class SlackAPI:
-    CACHE_VERSION=4
+class SlackRequestCancelled( SlackApiError ):
+    # stop_event が set されたので rate limit の待ちを打ち切った
+    def __init__( self, method ):
+        super().__init__( 'request cancelled: %s' % method, { 'ok': False, 'error': 'cancelled' } )
+
+
+class TokenBucket:
+    def __init__( self, rate_per_min, burst ):
+        self.rate= rate_per_min / 60.0
+        self.capacity= float(burst)
+        self.tokens= float(burst)
+        self.last_time= time.monotonic()
+        self.lock= threading.Lock()
+
+    def acquire( self, stop_event=None ):
+        # stop_event が set されたら待たずに False
+        while True:
+            with self.lock:
+                now= time.monotonic()
+                if now > self.last_time:
+                    self.tokens= min( self.capacity, self.tokens + (now - self.last_time) * self.rate )
+                    self.last_time= now
+                if now >= self.last_time and self.tokens >= 1.0:
+                    self.tokens-= 1.0
+                    return  True
+                wait_time= max( self.last_time - now, 0.0 ) + (1.0 - self.tokens) / self.rate
+            if stop_event is None:
+                time.sleep( wait_time )
+            elif stop_event.wait( wait_time ):
+                return  False
+
+    def block( self, sec ):
+        # Retry-After の間は補充を止める
+        with self.lock:
+            self.tokens= 0.0
+            self.last_time= max( self.last_time, time.monotonic() + sec )
+
+
+class SlackRateLimiter:
+    # https://api.slack.com/apis/rate-limits
+    #   tier: (requests per minute, burst)
+    TIER_MAP= {
+        1:      (1, 1),
+        2:      (20, 3),
+        3:      (50, 5),
+        4:      (100, 10),
+        'post': (60, 1),
+    }
+    METHOD_TIER_MAP= {
+        'auth_test':                4,
+        'chat_getPermalink':        4,
+        'chat_postMessage':         'post',
+        'chat_update':              3,
+        'conversations_history':    3,
+        'conversations_list':       2,
+        'conversations_replies':    3,
+        'users_info':               4,
+        'users_list':               2,
+    }
+    DEFAULT_TIER= 3
+    MAX_RETRY= 5
+    BACKOFF_BASE= 1.0
+
+    def __init__( self, rate_scale=1.0 ):
+        # rate_scale: 各 tier の requests per minute に掛ける倍率 (ベンチマーク用)
+        self.rate_scale= rate_scale
+        self.bucket_map= {}
+        self.lock= threading.Lock()
+
+    def get_bucket( self, method ):
+        with self.lock:
+            bucket= self.bucket_map.get( method, None )
+            if bucket is None:
+                tier= self.METHOD_TIER_MAP.get( method, self.DEFAULT_TIER )
+                rate_per_min,burst= self.TIER_MAP[tier]
+                bucket= TokenBucket( rate_per_min * self.rate_scale, burst )
+                self.bucket_map[method]= bucket
+            return  bucket
+
+    def get_retry_after( self, response ):
+        headers= response.headers or {}
+        for key in headers:
+            if key.lower() == 'retry-after':
+                try:
+                    return  float( headers[key] )
+                except ValueError:
+                    break
+        return  0.0
+
+    def call( self, method, func, *args, stop_event=None, **kwargs ):
+        # Retry-After と backoff の待ちも bucket で行うので stop_event で打ち切れる
+        bucket= self.get_bucket( method )
+        retry= 0
+        while True:
+            if not bucket.acquire( stop_event ):
+                raise SlackRequestCancelled( method )
+            try:
+                return  func( *args, **kwargs )
+            except SlackApiError as e:
+                if e.response is None or e.response.status_code != 429 or retry >= self.MAX_RETRY:
+                    raise
+                wait_time= max( self.get_retry_after( e.response ), self.BACKOFF_BASE * (2 ** retry) )
+                print( 'rate limited: %s (retry after %.1f sec)' % (method, wait_time), flush=True )
+                bucket.block( wait_time )
+                retry+= 1
+
+
+class RateLimitedClient:
+    # WebClient のメソッド呼び出しをすべて SlackRateLimiter 経由にする
+    #  metrics があれば API ごとの応答時間 (rate limit の待ちを除く) を記録する
+    #  stop_event が set されたら rate limit の待ちを打ち切って SlackRequestCancelled にする
+    def __init__( self, client, limiter, metrics=None, stop_event=None ):
+        self.client= client
+        self.limiter= limiter
+        self.metrics= metrics
+        self.stop_event= stop_event
+
+    def __getattr__( self, name ):
+        func= getattr( self.client, name )
+        if not callable( func ):
+            return  func
+        metrics= self.metrics
+        if metrics is None:
+            def call( *args, **kwargs ):
+                return  self.limiter.call( name, func, *args, stop_event=self.stop_event, **kwargs )
+            return  call
+        method= name.replace( '_', '.', 1 )
+        def request( *args, **kwargs ):
+            start_time= time.perf_counter()
+            status= 'ok'
+            try:
+                return  func( *args, **kwargs )
+            except SlackApiError as e:
+                status= 'error'
+                if e.response is not None and e.response.status_code == 429:
+                    status= 'ratelimited'
+                raise
+            finally:
+                metrics.observe( 'slack_request_seconds', time.perf_counter() - start_time, method=method )
+                metrics.add( 'slack_requests_total', 1, method=method, status=status )
+        def call( *args, **kwargs ):
+            return  self.limiter.call( name, request, *args, stop_event=self.stop_event, **kwargs )
+        return  call
+
+
+rate_limiter_map= {}
+rate_limiter_lock= threading.Lock()
+
+def get_rate_limiter( token, rate_scale=1.0 ):
+    # 制限はトークン(ワークスペース)単位なので同じトークンのインスタンスで共有する
+    key= (token, rate_scale)
+    with rate_limiter_lock:
+        if key not in rate_limiter_map:
+            rate_limiter_map[key]= SlackRateLimiter( rate_scale )
+        return  rate_limiter_map[key]
+
+#-------------------------------------------------------------------------------
 
-    def __init__( self, token, cache=None, public_only=False ):
-        self.client = WebClient( token=token )
+class JsonCache:
+    # 従来の json ファイルによるキャッシュ  保存時に全体を書き直す
+    def __init__( self, cache_file, version ):
+        self.cache_file= cache_file
+        self.version= version
         self.user_map= {}
         self.channel_map= {}
+        self.removed_channel_set= set()
+        self.missing_user_map= {}
+        self.meta_map= {}
+        self.user_index= None
+        self.channel_index= None
+        self.lock= threading.Lock()
+        cache= load_json( self.cache_file )
+        if cache:
+            print( 'load', self.cache_file, flush=True )
+            self.apply_cache( cache )
+
+    def apply_cache( self, cache ):
+        if cache.get( 'version', 0 ) != self.version:
+            return
+        self.user_map= dict( cache.get( 'user', {} ), **self.user_map )
+        # update_channels で削除した名前 (名前の変わったチャンネル) はファイルから戻さない
+        channel_map= { name: channel_id for name,channel_id in cache.get( 'channel', {} ).items() if name not in self.removed_channel_set }
+        self.channel_map= dict( channel_map, **self.channel_map )
+        self.missing_user_map= dict( cache.get( 'missing_user', {} ), **self.missing_user_map )
+        meta_map= { 'workspace_url': cache.get( 'team', {} ).get( 'url', None ), 'user_sync_time': cache.get( 'user_sync_time', 0 ) }
+        for key in meta_map:
+            if not self.meta_map.get( key, None ):
+                self.meta_map[key]= meta_map[key]
+        self.user_index= None
+        self.channel_index= None
+
+    def save( self ):
+        with save_lock:
+            # 同じキャッシュファイルを使う他のインスタンスの更新を残す
+            cache= load_json( self.cache_file )
+            if cache:
+                self.apply_cache( cache )
+            now= time.time()
+            self.missing_user_map= { user_id: expire for user_id,expire in self.missing_user_map.items() if expire > now }
+            self.removed_channel_set= set()
+            save_json_1( self.cache_file, {
+                    'user':             self.user_map,
+                    'channel':          self.channel_map,
+                    'missing_user':     self.missing_user_map,
+                    'user_sync_time':   self.meta_map.get( 'user_sync_time', 0 ),
+                    'team':             { 'url': self.meta_map.get( 'workspace_url', None ) },
+                    'version':          self.version,
+                } )
+        print( 'save', self.cache_file, flush=True )
+
+    def build_channel_index( self ):
+        # channel_id -> name
+        #  同じ id に複数の名前がある場合は後から登録された名前を使う
+        self.channel_index= {}
+        for name in self.channel_map:
+            self.channel_index[self.channel_map[name]]= name
+
+    def build_user_index( self ):
+        # user/display/real name -> user_id
+        #  名前が重複する場合は user > display > real の順、同順位なら id の小さい方を使う
+        self.user_index= {}
+        for key in ('real', 'display', 'user'):
+            for user_id in sorted( self.user_map, reverse=True ):
+                name= self.user_map[user_id].get( key, '' )
+                if name:
+                    self.user_index[name]= user_id
+
+    def get_user( self, user_id ):
+        return  self.user_map.get( user_id, None )
+
+    def find_user_id( self, user_name ):
+        with self.lock:
+            if self.user_index is None:
+                self.build_user_index()
+            return  self.user_index.get( user_name, None )
+
+    def update_users( self, user_list ):
+        for user_info in user_list:
+            self.user_map[user_info['id']]= user_info
+            self.missing_user_map.pop( user_info['id'], None )
+        self.user_index= None
+
+    def get_channel_id( self, channel_name ):
+        return  self.channel_map.get( channel_name, None )
+
+    def get_channel_name( self, channel_id ):
+        with self.lock:
+            if self.channel_index is None:
+                self.build_channel_index()
+            return  self.channel_index.get( channel_id, None )
+
+    def update_channels( self, channel_list ):
+        # channel_list: [(name, channel_id)]  同じ id の古い名前は削除する
+        channel_id_set= set( channel_id for name,channel_id in channel_list )
+        for name in list( self.channel_map ):
+            if self.channel_map[name] in channel_id_set:
+                del self.channel_map[name]
+                self.removed_channel_set.add( name )
+        for name,channel_id in channel_list:
+            self.channel_map[name]= channel_id
+            self.removed_channel_set.discard( name )
+        self.channel_index= None
+
+    def get_missing_user( self, user_id ):
+        return  self.missing_user_map.get( user_id, 0 )
+
+    def set_missing_user( self, user_id, expire ):
+        self.missing_user_map[user_id]= expire
+
+    def get_meta( self, key, default=None ):
+        value= self.meta_map.get( key, None )
+        if value is None:
+            return  default
+        return  value
+
+    def set_meta( self, key, value ):
+        self.meta_map[key]= value
+
+
+class SqliteCache:
+    # sqlite によるキャッシュ  行単位で更新し、名前と id の両方に索引を持つ
+    SCHEMA= [
+        'CREATE TABLE IF NOT EXISTS user( id TEXT PRIMARY KEY, user TEXT, display TEXT, real TEXT, bot INTEGER )',
+        'CREATE INDEX IF NOT EXISTS user_user ON user( user )',
+        'CREATE INDEX IF NOT EXISTS user_display ON user( display )',
+        'CREATE INDEX IF NOT EXISTS user_real ON user( real )',
+        'CREATE TABLE IF NOT EXISTS channel( name TEXT PRIMARY KEY, id TEXT )',
+        'CREATE INDEX IF NOT EXISTS channel_id ON channel( id )',
+        'CREATE TABLE IF NOT EXISTS missing_user( id TEXT PRIMARY KEY, expire REAL )',
+        'CREATE TABLE IF NOT EXISTS meta( key TEXT PRIMARY KEY, value TEXT )',
+    ]
+
+    def __init__( self, cache_file, version ):
+        self.cache_file= cache_file
+        self.version= version
+        self.lock= threading.Lock()
+        print( 'open', self.cache_file, flush=True )
+        self.conn= sqlite3.connect( self.cache_file, timeout=30.0, check_same_thread=False )
+        with self.lock, self.conn:
+            self.conn.execute( 'PRAGMA journal_mode=WAL' )
+            for sql in self.SCHEMA:
+                self.conn.execute( sql )
+        if self.get_meta( 'version', 0 ) != self.version:
+            self.migrate()
+
+    def migrate( self ):
+        # 同名の json キャッシュ (CACHE_VERSION=4) があれば取り込む
+        with self.lock, self.conn:
+            for table in ('user', 'channel', 'missing_user', 'meta'):
+                self.conn.execute( 'DELETE FROM %s' % table )
+        json_file= os.path.splitext( self.cache_file )[0] + '.json'
+        cache= load_json( json_file )
+        if cache and cache.get( 'version', 0 ) == self.version:
+            print( 'migrate', json_file, flush=True )
+            self.update_users( cache.get( 'user', {} ).values() )
+            self.update_channels( [(name, channel_id) for name,channel_id in cache.get( 'channel', {} ).items()] )
+            for user_id,expire in cache.get( 'missing_user', {} ).items():
+                self.set_missing_user( user_id, expire )
+            self.set_meta( 'workspace_url', cache.get( 'team', {} ).get( 'url', None ) )
+            self.set_meta( 'user_sync_time', cache.get( 'user_sync_time', 0 ) )
+        self.set_meta( 'version', self.version )
+
+    def save( self ):
+        # 更新は都度コミット済み  期限切れの負キャッシュだけ削除する
+        with self.lock, self.conn:
+            self.conn.execute( 'DELETE FROM missing_user WHERE expire <= ?', (time.time(),) )
+
+    def query_one( self, sql, args ):
+        with self.lock:
+            return  self.conn.execute( sql, args ).fetchone()
+
+    def get_user( self, user_id ):
+        row= self.query_one( 'SELECT id, user, display, real, bot FROM user WHERE id=?', (user_id,) )
+        if row is None:
+            return  None
+        return  { 'user': row[1], 'display': row[2], 'real': row[3], 'id': row[0], 'bot': bool(row[4]) }
+
+    def find_user_id( self, user_name ):
+        if not user_name:
+            return  None
+        for key in ('user', 'display', 'real'):
+            row= self.query_one( 'SELECT id FROM user WHERE %s=? ORDER BY id LIMIT 1' % key, (user_name,) )
+            if row is not None:
+                return  row[0]
+        return  None
+
+    def update_users( self, user_list ):
+        with self.lock, self.conn:
+            for user_info in user_list:
+                self.conn.execute( 'INSERT OR REPLACE INTO user( id, user, display, real, bot ) VALUES( ?, ?, ?, ?, ? )',
+                        (user_info['id'], user_info['user'], user_info['display'], user_info['real'], int(user_info['bot'])) )
+                self.conn.execute( 'DELETE FROM missing_user WHERE id=?', (user_info['id'],) )
+
+    def get_channel_id( self, channel_name ):
+        row= self.query_one( 'SELECT id FROM channel WHERE name=?', (channel_name,) )
+        if row is None:
+            return  None
+        return  row[0]
+
+    def get_channel_name( self, channel_id ):
+        row= self.query_one( 'SELECT name FROM channel WHERE id=? ORDER BY rowid DESC LIMIT 1', (channel_id,) )
+        if row is None:
+            return  None
+        return  row[0]
+
+    def update_channels( self, channel_list ):
+        # channel_list: [(name, channel_id)]  同じ id の古い名前は削除する
+        with self.lock, self.conn:
+            for name,channel_id in channel_list:
+                self.conn.execute( 'DELETE FROM channel WHERE id=? AND name<>?', (channel_id, name) )
+                self.conn.execute( 'INSERT OR REPLACE INTO channel( name, id ) VALUES( ?, ? )', (name, channel_id) )
+
+    def get_missing_user( self, user_id ):
+        row= self.query_one( 'SELECT expire FROM missing_user WHERE id=?', (user_id,) )
+        if row is None:
+            return  0
+        return  row[0]
+
+    def set_missing_user( self, user_id, expire ):
+        with self.lock, self.conn:
+            self.conn.execute( 'INSERT OR REPLACE INTO missing_user( id, expire ) VALUES( ?, ? )', (user_id, expire) )
+
+    def get_meta( self, key, default=None ):
+        row= self.query_one( 'SELECT value FROM meta WHERE key=?', (key,) )
+        if row is None:
+            return  default
+        value= json.loads( row[0] )
+        if value is None:
+            return  default
+        return  value
+
+    def set_meta( self, key, value ):
+        with self.lock, self.conn:
+            self.conn.execute( 'INSERT OR REPLACE INTO meta( key, value ) VALUES( ?, ? )', (key, json.dumps( value )) )
+
+
+def open_cache( cache_file, version ):
+    # 拡張子が .db / .sqlite なら sqlite、それ以外は json
+    if os.path.splitext( cache_file )[1] in ('.db', '.sqlite', '.sqlite3'):
+        return  SqliteCache( cache_file, version )
+    return  JsonCache( cache_file, version )
+
+#-------------------------------------------------------------------------------
+
+class SlackAPI:
+    CACHE_VERSION=4
+
+    def __init__( self, token, cache=None, public_only=False, user_sync_days=0, missing_user_ttl=24*60*60, offline=False, base_url=None, metrics=None, stop_event=None, rate_scale=1.0 ):
+        # base_url: Web API の URL (ベンチマーク用のローカルサーバーなど)
+        # rate_scale: rate limit の倍率 (ベンチマーク用)
+        # metrics: RunMetrics  API の応答時間とユーザー情報のキャッシュヒット率を記録する
+        # stop_event: set されたら rate limit の待ちを打ち切る (time_budget の締め切り)
+        if base_url:
+            web_client= WebClient( token=token, base_url=base_url )
+        else:
+            web_client= WebClient( token=token )
+        self.metrics= metrics
+        self.client = RateLimitedClient( web_client, get_rate_limiter( token, rate_scale ), metrics, stop_event )
+        self.user_sync_days= user_sync_days
+        self.missing_user_ttl= missing_user_ttl
         self.cache_file= 'slack_cache.json'
         if cache:
             self.cache_file= cache
         self.public_only= public_only
+        self.offline= offline
+        self.workspace_url_error= offline
         self.load_cache()
 
     def load_cache( self ):
         self.cache_updated= 0
-        cache= load_json( self.cache_file )
-        if cache:
-            print( 'load', self.cache_file, flush=True )
-            ver= cache.get( 'version', 0 )
-            if ver != self.CACHE_VERSION:
-                cache= {}
-            self.user_map= cache.get( 'user', {} )
-            self.channel_map= cache.get( 'channel', {} )
+        self.cache= open_cache( self.cache_file, self.CACHE_VERSION )
 
     def save_cache( self ):
         if (self.cache_updated & 0xff) != 0:
-            save_json( self.cache_file, {'user':self.user_map, 'channel':self.channel_map, 'version':self.CACHE_VERSION} )
+            self.cache.save()
             self.cache_updated= (self.cache_updated << 8) & 0xff00
-            print( 'save', self.cache_file, flush=True )
 
     #--------------------------------------------------------------------------
 
@@ -78,7 +493,6 @@ class SlackAPI:
             if not self.public_only:
                 types+= ',private_channel'
             result= self.client.conversations_list( cursor=cursor, limit=800, types=types )
-            time.sleep( 2.0 )
             channels= result.get( 'channels', [] )
             all_channels.extend( channels )
             cursor= result.get( 'response_metadata', {} ).get( 'next_cursor', None )
@@ -87,14 +501,11 @@ class SlackAPI:
         return  all_channels
 
     def refresh_channels( self ):
-        if (self.cache_updated & 0x101) != 0:
+        if (self.cache_updated & 0x101) != 0 or self.offline:
             return
         try:
             channels= self.get_all_channels()
-            for channel in channels:
-                channel_id= channel['id']
-                name= channel['name']
-                self.channel_map[name]= channel_id
+            self.cache.update_channels( [(channel['name'], channel['id']) for channel in channels] )
             self.cache_updated|= 1
         except SlackApiError as e:
             print( 'Error fetching channels: %s' % str(e.response['error']) )
@@ -102,16 +513,14 @@ class SlackAPI:
     def get_channel_id( self, channel_name ):
         if channel_name.startswith( '#' ):
             channel_name= channel_name[1:]
-        if channel_name in self.channel_map:
-            return  self.channel_map[channel_name]
+        channel_id= self.cache.get_channel_id( channel_name )
+        if channel_id:
+            return  channel_id
         self.refresh_channels()
-        return  self.channel_map.get( channel_name, None )
+        return  self.cache.get_channel_id( channel_name )
 
     def get_channel_name_1( self, channel_id ):
-        for name in self.channel_map:
-            if channel_id == self.channel_map[name]:
-                return  name
-        return  None
+        return  self.cache.get_channel_name( channel_id )
 
     def get_channel_name( self, channel_id ):
         channel_name= self.get_channel_name_1( channel_id )
@@ -122,55 +531,86 @@ class SlackAPI:
 
     #--------------------------------------------------------------------------
 
+    def make_user_info( self, user ):
+        user_id= user.get( 'id', 'Unknown' )
+        user_name= user.get( 'name', 'Unknown' )
+        real_name= user.get( 'real_name', '' )
+        display_name= user.get( 'profile', {} ).get( 'display_name', '' )
+        user_info= {
+            'user':     user_name,
+            'display':  display_name,
+            'real':     real_name,
+            'id':       user_id,
+            'bot':      user.get('is_bot',False),
+        }
+        return  user_info
+
     def get_all_users( self ):
-        all_user_map= {}
+        all_user_list= []
         cursor= None
         while True:
-            time.sleep( 3.0 )
             result= self.client.users_list( cursor= cursor )
-            time.sleep( 3.0 )
             users= result.get( 'members', [] )
             for user in users:
-                user_id= user.get( 'id', 'Unknown' )
-                user_name= user.get( 'name', 'Unknown' )
-                real_name= user.get( 'real_name', '' )
-                display_name= user.get( 'profile', {} ).get( 'display_name', '' )
-                user_info= {
-                    'user':     user_name,
-                    'display':  display_name,
-                    'real':     real_name,
-                    'id':       user_id,
-                    'bot':      user.get('is_bot',False),
-                }
-                all_user_map[user_id]= user_info
+                all_user_list.append( self.make_user_info( user ) )
             cursor= result.get( 'response_metadata', {} ).get( 'next_cursor', None )
             if cursor is None or cursor == '' or users == []:
                 break
-        return  all_user_map
+        return  all_user_list
 
     def refresh_users( self ):
-        if (self.cache_updated & 0x202) != 0:
+        if (self.cache_updated & 0x202) != 0 or self.offline:
             return
         try:
-            self.user_map= self.get_all_users()
+            self.cache.update_users( self.get_all_users() )
+            self.cache.set_meta( 'user_sync_time', time.time() )
             self.cache_updated|= 2
         except SlackApiError as e:
             print( 'Error fetching user lists: %s' % str(e.response['error']) )
 
-    def get_user_info( self, user_id ):
-        if user_id in self.user_map:
-            return  self.user_map[user_id]
-        self.refresh_users()
-        if user_id in self.user_map:
-            return  self.user_map[user_id]
+    def sync_users( self ):
+        # user_sync_days ごとにユーザー一覧全体を取り直す
+        if self.user_sync_days > 0 and self.cache.get_meta( 'user_sync_time', 0 ) < time.time() - self.user_sync_days * 24*60*60:
+            self.refresh_users()
+
+    def fetch_user_info( self, user_id ):
+        # 未知のユーザーは users.info で 1 件だけ取得する
+        expire= self.cache.get_missing_user( user_id )
+        if expire > time.time() or self.offline:
+            return  None
+        try:
+            user= self.client.users_info( user=user_id ).get( 'user', None )
+        except SlackApiError as e:
+            error= str(e.response['error'])
+            if error == 'user_not_found':
+                self.cache.set_missing_user( user_id, time.time() + self.missing_user_ttl )
+                self.cache_updated|= 8
+            else:
+                print( 'Error fetching user info: %s' % error )
+            return  None
+        if user is None:
+            return  None
+        user_info= self.make_user_info( user )
+        self.cache.update_users( [user_info] )
+        self.cache_updated|= 8
+        return  user_info
+
+    def get_user_info( self, user_id, fetch=True ):
+        # fetch=False ならキャッシュにないユーザーを取得しない
+        user_info= self.cache.get_user( user_id )
+        if self.metrics is not None:
+            self.metrics.add( 'cache_requests_total', 1, cache='slack_user', result='hit' if user_info else 'miss' )
+        if user_info:
+            return  user_info
+        user_info= None
+        if fetch:
+            user_info= self.fetch_user_info( user_id )
+        if user_info:
+            return  user_info
         return  { 'user':'Unknown', 'display':'Unknown', 'real':'Unknown', 'id':'Unknown', 'bot':False }
 
     def get_user_id_1( self, user_name ):
-        for user_id in self.user_map:
-            user_info= self.user_map[user_id]
-            if user_name == user_info['user'] or user_name == user_info['display'] or user_name == user_info['real']:
-                return  user_id
-        return  None
+        return  self.cache.find_user_id( user_name )
 
     def get_user_id( self, user_name ):
         if user_name.startswith( '@' ):
@@ -183,19 +623,58 @@ class SlackAPI:
 
     #--------------------------------------------------------------------------
 
+    def get_workspace_url( self ):
+        url= self.cache.get_meta( 'workspace_url', None )
+        if url is None and not self.workspace_url_error:
+            try:
+                url= self.client.auth_test().get( 'url', '' )
+                if url != '' and not url.endswith( '/' ):
+                    url+= '/'
+                self.cache.set_meta( 'workspace_url', url )
+                self.cache_updated|= 4
+            except SlackApiError as e:
+                # 今回の実行中は chat.getPermalink を使う
+                print( 'Error fetching workspace url: %s' % str(e.response['error']) )
+                self.workspace_url_error= True
+        return  url
+
+    def get_permalink( self, channel_id, message_ts, thread_ts=None, fetch=True ):
+        # https://<workspace>.slack.com/archives/<channel_id>/p<ts>
+        #  fetch=False なら workspace の url が分からない場合に chat.getPermalink を呼ばない
+        base_url= self.get_workspace_url()
+        if base_url:
+            url= '%sarchives/%s/p%s' % (base_url, channel_id, message_ts.replace( '.', '' ))
+            if thread_ts and thread_ts != message_ts:
+                url+= '?thread_ts=%s&cid=%s' % (thread_ts, channel_id)
+            return  url
+        if self.offline or not fetch:
+            return  ''
+        response= self.client.chat_getPermalink( channel=channel_id, message_ts=message_ts )
+        return  response.get( 'permalink', '' )
+
+    #--------------------------------------------------------------------------
+
     def post_message( self, channel_name, text, blocks=None, markdown_text= None, thread_ts=None, parent_response=None ):
         if (thread_ts is None) and (parent_response is not None):
             thread_ts= parent_response.get('ts', None)
         try:
             channel_id= self.get_channel_id( channel_name )
             response= self.client.chat_postMessage( channel=channel_id, text=text, blocks=blocks, markdown_text=markdown_text, thread_ts=thread_ts )
-            time.sleep( 1.0 )
             return  response
         except SlackApiError as e:
             print( 'Error sending message: %s' % str(e.response['error']) )
             return  None
         self.save_cache()
 
+    def update_message( self, channel_name, ts, text, blocks=None ):
+        try:
+            channel_id= self.get_channel_id( channel_name )
+            response= self.client.chat_update( channel=channel_id, ts=ts, text=text, blocks=blocks )
+            return  response
+        except SlackApiError as e:
+            print( 'Error updating message: %s' % str(e.response['error']) )
+            return  None
+
 #-------------------------------------------------------------------------------
 
 def usage():
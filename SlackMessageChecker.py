@@ -2,13 +2,16 @@
 
 import os
 import sys
-import datetime
 import time
+import datetime
+import contextlib
+import concurrent.futures
 
 lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
     sys.path.append( lib_path )
 import SlackAPI
+import MessageArchive
 
 #-------------------------------------------------------------------------------
 
@@ -21,9 +24,47 @@ class ThreadInfo:
 
 class SlackMessageChecker:
     DATEFORMAT = '%Y-%m-%d %H:%M:%S'
-
-    def __init__(self, token, cache=None):
-        self.api= SlackAPI.SlackAPI( token, cache )
+    CRAWL_STATE_VERSION = 1
+
+    def __init__(self, token, cache=None, crawl_state=None, open_days=None, fetch_concurrency=1, user_sync_days=0, archive=None, offline=False, base_url=None, metrics=None, refresh_hours=168, stop_event=None, rate_scale=1.0):
+        # stop_event: set されたら以降のリプライは取得せず、Slack API の rate limit の待ちも打ち切る
+        self.metrics= metrics
+        self.stop_event= stop_event
+        self.crawled_channel_set= set()
+        self.api= SlackAPI.SlackAPI( token, cache, user_sync_days=user_sync_days, offline=offline, base_url=base_url, metrics=metrics, stop_event=stop_event, rate_scale=rate_scale )
+        self.archive= None
+        if archive:
+            self.archive= MessageArchive.MessageArchive( archive )
+        self.offline= offline and self.archive is not None
+        self.fetch_concurrency= max(1, fetch_concurrency)
+        self.crawl_state_file= crawl_state
+        self.open_days= open_days
+        self.refresh_hours= refresh_hours
+        self.load_crawl_state()
+
+    def load_crawl_state(self):
+        # チャンネルごとの取得済み位置 (latest_ts) と未完了スレッド (threads) を読み込む
+        self.crawl_state= {}
+        if self.crawl_state_file is None:
+            return
+        state= SlackAPI.load_json(self.crawl_state_file)
+        if state and state.get('version', 0) == self.CRAWL_STATE_VERSION:
+            self.crawl_state= state.get('channel', {})
+
+    def save_crawl_state(self):
+        if self.crawl_state_file is None:
+            return
+        SlackAPI.save_json(self.crawl_state_file, {'channel':self.crawl_state, 'version':self.CRAWL_STATE_VERSION})
+
+    def stage(self, name):
+        # metrics があれば段階ごとの時間を記録する
+        if self.metrics is None:
+            return  contextlib.nullcontext()
+        return  self.metrics.stage(name)
+
+    def add_archive_count(self, result):
+        if self.metrics is not None:
+            self.metrics.add('cache_requests_total', 1, cache='archive_replies', result=result)
 
     def get_date_string(self, ts):
         if type(ts) is not float:
@@ -33,79 +74,274 @@ class SlackMessageChecker:
         date = datetime.datetime.fromtimestamp(ts)
         return  date.strftime(self.DATEFORMAT)
 
+    HISTORY_LIMIT = 999
+
+    def get_channel_history(self, channel_id, oldest, latest=None):
+        # チャンネル内のメッセージ履歴を取得
+        #  期間全体を取り直すことが多いので 1 ページを上限 (既定の 100 件の約 10 倍) にして呼び出し回数を減らす
+        has_more = True
+        next_cursor = None
+        all_messages = []  # 全メッセージを格納するリスト
+
+        while has_more:
+            response = self.api.client.conversations_history(
+                channel=channel_id, 
+                oldest=oldest,
+                latest=latest,
+                cursor=next_cursor,
+                limit=self.HISTORY_LIMIT
+            )
+            messages = response.get("messages", [])
+            all_messages.extend(messages)  # 取得したメッセージをリストに追加
+            has_more = response.get("has_more", False)
+            next_cursor = response.get("response_metadata", {}).get("next_cursor")
+        return  all_messages
+
+    def get_reopen_oldest(self, oldest, specified_ts, open_ts, thread_ts_list):
+        # 前回の取得範囲より古いスレッドへの新しいリプライを拾えるように、履歴の取得開始位置を戻す
+        #  open_ts が指定期間の先頭以前 (thread_open_days 未指定) なら指定期間全体を取り直す
+        #  thread_open_days を短くした場合は、未完了スレッド (thread_ts_list) のうち最も古いものから取り直す
+        #  古いスレッドに付いた新しいリプライは親メッセージの latest_reply にしか現れないので、見落とさないためには取り直しが必要
+        #  1 ページ 999 件で取得するので、スレッドごとに conversations.replies で確認するより呼び出し回数が少ない
+        if open_ts <= specified_ts:
+            return  specified_ts
+        for thread_ts in thread_ts_list:
+            if float(thread_ts) >= specified_ts:
+                oldest= min(oldest, float(thread_ts))
+        return  oldest
+
+    def is_replies_complete(self, message, replies):
+        # 保存済みのリプライが親メッセージの reply_count と latest_reply に一致しているか
+        if len(replies) != message.get('reply_count', 0) + 1:
+            return  False
+        latest_reply= float(message.get('latest_reply', '0'))
+        return  max(float(reply.get('ts', '0')) for reply in replies) >= latest_reply
+
+    def fetch_replies(self, channel_id, thread_ts, oldest=None):
+        # スレッドのリプライをページ単位ですべて取得する
+        replies= []
+        next_cursor= None
+        while True:
+            response = self.api.client.conversations_replies(channel=channel_id, ts=thread_ts, oldest=oldest, cursor=next_cursor, limit=200)
+            replies.extend(response.get("messages", []))
+            next_cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not response.get("has_more", False) or not next_cursor:
+                break
+        return  replies
+
+    def get_thread_replies(self, channel_id, message):
+        with self.stage('replies'):
+            return  self.get_thread_replies_1(channel_id, message)
+
+    def is_replies_stale(self, channel_id, thread_ts):
+        # 前回スレッド全体を取得してから refresh_hours を過ぎたか
+        #  差分取得では既存のリプライの編集や削除が反映されないので、更新の続くスレッドは定期的に取り直す
+        if self.offline:
+            return  False
+        return  self.archive.get_replies_time(channel_id, thread_ts) < time.time() - self.refresh_hours * 60*60
+
+    def get_thread_replies_1(self, channel_id, message):
+        # archive に揃っていれば hit、差分だけ取得したら partial、全体を取得したら miss
+        thread_ts= message['ts']
+        if self.archive is not None and not self.is_replies_stale(channel_id, thread_ts):
+            replies= self.archive.get_replies(channel_id, thread_ts)
+            if self.offline or self.is_replies_complete(message, replies):
+                self.add_archive_count('hit')
+                return  replies
+            if len(replies) >= 2:
+                # 保存済みの最後のリプライより新しいものだけ取得してマージする
+                latest_ts= replies[-1]['ts']
+                new_replies= [reply for reply in self.fetch_replies(channel_id, thread_ts, latest_ts) if reply['ts'] != latest_ts]
+                self.archive.add_messages(channel_id, [message] + new_replies)
+                replies= self.archive.get_replies(channel_id, thread_ts)
+                if self.is_replies_complete(message, replies):
+                    self.add_archive_count('partial')
+                    return  replies
+                # 件数が合わない (途中のリプライの削除など) 場合はスレッド全体を取り直す
+        replies = self.fetch_replies(channel_id, thread_ts)
+        if self.archive is not None:
+            self.add_archive_count('miss')
+            self.archive.set_replies(channel_id, thread_ts, replies)
+        return  replies
+
+    def get_archived_messages(self, channel_id, specified_ts, recent_ts, open_ts, carry_list=()):
+        # 保存済みの履歴を使い、足りない範囲と更新分だけ取得する
+        if not self.offline:
+            crawl_ts= time.time()
+            archived_oldest= specified_ts
+            oldest= specified_ts
+            channel_range= self.archive.get_channel_range(channel_id)
+            if channel_range is not None:
+                archived_oldest,archived_latest= channel_range
+                if specified_ts < archived_oldest:
+                    messages= self.get_channel_history(channel_id, specified_ts, archived_oldest)
+                    self.archive.add_history(channel_id, messages, specified_ts, archived_oldest)
+                    archived_oldest= specified_ts
+                oldest= max(specified_ts, min(archived_latest, recent_ts))
+                oldest= self.get_reopen_oldest(oldest, specified_ts, open_ts, self.archive.get_open_threads(channel_id, specified_ts, open_ts) + list(carry_list))
+            messages= self.get_channel_history(channel_id, oldest)
+            self.archive.add_history(channel_id, messages, oldest)
+            self.archive.set_channel_range(channel_id, archived_oldest, crawl_ts)
+        return  self.archive.get_history(channel_id, specified_ts)
+
+    def get_channel_messages(self, channel_id, specified_ts, recent_ts, open_ts, carry_list=()):
+        with self.stage('crawl'):
+            return  self.get_channel_messages_1(channel_id, specified_ts, recent_ts, open_ts, carry_list)
+
+    def get_channel_messages_1(self, channel_id, specified_ts, recent_ts, open_ts, carry_list=()):
+        # carry_list: 前回持ち越したスレッドの ts  履歴の取得範囲に含める
+        if self.archive is not None:
+            return  self.get_archived_messages(channel_id, specified_ts, recent_ts, open_ts, carry_list)
+        if self.crawl_state_file is None:
+            return  self.get_channel_history(channel_id, specified_ts)
+
+        # 前回の取得位置以降の履歴のみ取得する (更新判定期間と未完了スレッドは常に再取得)
+        state= self.crawl_state.get(channel_id, {'latest_ts': '0', 'threads': {}})
+        oldest= max(specified_ts, min(float(state['latest_ts']), recent_ts))
+        open_list= [thread_ts for thread_ts,latest_reply in state['threads'].items() if float(latest_reply) >= open_ts]
+        oldest= self.get_reopen_oldest(oldest, specified_ts, open_ts, open_list + list(carry_list))
+        all_messages= self.get_channel_history(channel_id, oldest)
+
+        # 取得位置と未完了スレッドを更新
+        latest_ts= state['latest_ts']
+        threads= {}
+        for message in all_messages:
+            message_ts= message.get('ts', '0')
+            if float(message_ts) > float(latest_ts) and message.get('thread_ts', message_ts) == message_ts:
+                latest_ts= message_ts
+            if message.get('reply_count', 0) >= 1 and 'latest_reply' in message:
+                if float(message['latest_reply']) >= open_ts and float(message_ts) >= specified_ts:
+                    threads[message_ts]= message['latest_reply']
+        self.crawl_state[channel_id]= {'latest_ts': latest_ts, 'threads': threads}
+        return  all_messages
+
     def get_recent_messages(self, recent_days, specified_days, target_channels):
+        return  list(self.iter_recent_messages(recent_days, specified_days, target_channels))
+
+    def select_messages(self, all_messages, recent_date, carry_list=()):
+        # 最近のメッセージまたはリプライがあるか判定
+        #  carry_list: 前回持ち越したスレッドの ts  更新がなくても選ぶ
+        #  return: [(message_num, message, リプライ取得が必要か)]
+        select_list= []
+        for message_num,message in enumerate(all_messages):
+            message_ts = float(message.get('ts', '0'))
+            message_date = datetime.datetime.fromtimestamp(message_ts)
+            reply_count = message.get('reply_count',0)
+            if message.get('ts', '0') in carry_list:
+                select_list.append((message_num+1, message, reply_count >= 1))
+            elif reply_count >= 1:
+                if 'latest_reply' in message:
+                    latest_reply_ts= float(message.get('latest_reply', '0'))
+                    latest_reply_date = datetime.datetime.fromtimestamp(latest_reply_ts)
+                    if latest_reply_date > recent_date:
+                        select_list.append((message_num+1, message, True))
+            else:
+                if message_date >= recent_date:
+                    select_list.append((message_num+1, message, False))
+        return  select_list
+
+    def is_stopped(self):
+        return  self.stop_event is not None and self.stop_event.is_set()
+
+    def wait_future(self, future):
+        # 取得の完了を待つ  stop_event が set されたら待たずに False (打ち切られた取得も False)
+        if future is None or self.stop_event is None:
+            return  True
+        while not future.done() and not self.stop_event.is_set():
+            concurrent.futures.wait([future], timeout=0.5)
+        if self.stop_event.is_set():
+            return  future.done() and not future.cancelled() and future.exception() is None
+        return  True
+
+    def iter_recent_messages(self, recent_days, specified_days, target_channels, today_date=None, skip_set=None, carry_set=None):
+        # 見つかったスレッドから順に返す
+        #  today_date: 期間の基準日時 (再開時に前回と同じ期間にする)
+        #  skip_set: (channel_id, ts) のスレッドはリプライを取得せず親メッセージだけを返す
+        #  carry_set: (channel_id, ts) のスレッドは更新がなくても返す (前回の持ち越し)
+        #  stop_event が set されたら以降のリプライは取得せず、親メッセージだけを 'deferred' として返す
+        #  履歴の揃っていないチャンネルは飛ばす  履歴を使ったチャンネルは crawled_channel_set に入れる
         if target_channels is None or target_channels == []:
-            return []
+            return
 
         # 計算: 指定日と更新判定期間
-        today_date = datetime.datetime.now()
-        specified_date = datetime.datetime.now() - datetime.timedelta(days=specified_days)
-        recent_date = datetime.datetime.now() - datetime.timedelta(days=recent_days)
+        if today_date is None:
+            today_date = datetime.datetime.now()
+        specified_date = today_date - datetime.timedelta(days=specified_days)
+        recent_date = today_date - datetime.timedelta(days=recent_days)
+        # open_days 未指定なら指定期間内のスレッドは全て新しいリプライが付く可能性があるものとして扱う
+        open_days= specified_days if self.open_days is None else self.open_days
+        open_date = today_date - datetime.timedelta(days=max(open_days, recent_days))
         date_info= (today_date.strftime(self.DATEFORMAT), specified_date.strftime(self.DATEFORMAT), recent_date.strftime(self.DATEFORMAT))
 
+        executor= concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_concurrency)
         try:
-            result = []
-
-            for channel_name in target_channels:
-                channel_id= self.api.get_channel_id(channel_name)
+            thread_count = 0
+            self.crawled_channel_set= set()
+            self.api.sync_users()
+
+            # チャンネルの履歴取得をまとめて投入する
+            channel_list= [(channel_name, self.api.get_channel_id(channel_name)) for channel_name in target_channels]
+            carry_map= {}
+            for channel_id,message_ts in carry_set or ():
+                carry_map.setdefault(channel_id, set()).add(message_ts)
+            history_list= []
+            for channel_name,channel_id in channel_list:
+                history_list.append(executor.submit(self.get_channel_messages, channel_id, specified_date.timestamp(), recent_date.timestamp(), open_date.timestamp(), carry_map.get(channel_id, set())))
+            replies_list= [None] * len(channel_list)
+
+            def submit_replies(index):
+                # 履歴の揃ったチャンネルからスレッドのリプライ取得を投入する
+                if replies_list[index] is None:
+                    channel_id= channel_list[index][1]
+                    if not self.wait_future(history_list[index]):
+                        history_list[index].cancel()
+                        replies_list[index]= (0, [])
+                        return  replies_list[index]
+                    all_messages= history_list[index].result()
+                    self.crawled_channel_set.add(channel_id)
+                    all_messages.sort(key=lambda message: float(message.get('ts', '0')), reverse=True)
+                    job_list= []
+                    for message_num,message,need_replies in self.select_messages(all_messages, recent_date, carry_map.get(channel_id, set())):
+                        future= None
+                        if skip_set and (channel_id, message.get('ts', '0')) in skip_set:
+                            need_replies= False
+                        if need_replies and not self.is_stopped():
+                            future= executor.submit(self.get_thread_replies, channel_id, message)
+                        job_list.append((message_num, message, future))
+                    replies_list[index]= (len(all_messages), job_list)
+                return  replies_list[index]
+
+            for index,(channel_name,channel_id) in enumerate(channel_list):
                 print( '* channel=[%s] (%s)' % (channel_name, channel_id) )
-
-                # チャンネル内のメッセージ履歴を取得
-                has_more = True
-                next_cursor = None
-                all_messages = []  # 全メッセージを格納するリスト
-
-                while has_more:
-                    response = self.api.client.conversations_history(
-                        channel=channel_id, 
-                        oldest=specified_date.timestamp(),
-                        cursor=next_cursor
-                    )
-                    messages = response.get("messages", [])
-                    all_messages.extend(messages)  # 取得したメッセージをリストに追加
-                    has_more = response.get("has_more", False)
-                    next_cursor = response.get("response_metadata", {}).get("next_cursor")
-                    time.sleep( 1.0 )
-
-                message_count= len(all_messages)
+                message_count,job_list= submit_replies(index)
+                for next_index in range(index+1, len(channel_list)):
+                    if history_list[next_index].done():
+                        submit_replies(next_index)
                 print( '  messages=', message_count )
 
-                message_num= 0
-                for message in all_messages:  # すべてのメッセージを処理
-                    message_ts = float(message.get('ts', '0'))
-                    message_date = datetime.datetime.fromtimestamp(message_ts)
+                for message_num,message,future in job_list:
+                    replies= [message]
+                    deferred= self.is_stopped() or not self.wait_future(future)
+                    if deferred:
+                        if future is not None:
+                            future.cancel()
+                    elif future is not None:
+                        replies= future.result()
+                    message_date = datetime.datetime.fromtimestamp(float(message.get('ts', '0')))
                     reply_count = message.get('reply_count',0)
                     reply_users_count = message.get('reply_users_count',0)
+                    print( '    %d/%d %s replies=%d  user=%d%s' % (message_num,message_count,message_date,reply_count,reply_users_count,'  deferred' if deferred else ''), flush=True )
+                    thread_count+= 1
+                    yield {"channel": (channel_name, channel_id), "messages": replies, "date":date_info, "deferred": deferred}
 
-                    appended= False
-
-                    # 最近のメッセージまたはリプライがあるか判定
-                    if reply_count >= 1:
-                        if 'latest_reply' in message:
-                            latest_reply_ts= float(message.get('latest_reply', '0'))
-                            latest_reply_date = datetime.datetime.fromtimestamp(latest_reply_ts)
-                            if latest_reply_date > recent_date:
-                                # スレッドのリプライを確認
-                                replies = self.api.client.conversations_replies(channel=channel_id, ts=message["ts"]).get("messages", [])
-                                time.sleep( 1.0 )
-                                result.append({"channel": (channel_name, channel_id), "messages": replies, "date":date_info})
-                                appended= True
-                    else:
-                        if message_date >= recent_date:
-                            result.append({"channel": (channel_name, channel_id), "messages": [message], "date":date_info})
-                            appended= True
-
-                    message_num+= 1
-                    if appended:
-                        print( '    %d/%d %s replies=%d  user=%d' % (message_num,message_count,message_date,reply_count,reply_users_count), flush=True )
-
-            print( '* Total %d threads' % len(result), flush=True )
-            return result
+            print( '* Total %d threads' % thread_count, flush=True )
+            self.save_crawl_state()
 
         except SlackAPI.SlackApiError as e:
             print(f"Error fetching messages: {e.response['error']}")
-            return []
         finally:
+            # 締め切りを過ぎた場合は実行中の取得を待たない
+            executor.shutdown(wait=not self.is_stopped(), cancel_futures=True)
             self.api.save_cache()
 
     def userinfo_to_string(self, user_info):
@@ -124,6 +360,11 @@ class SlackMessageChecker:
         return  '\n'.join(replies_list)
 
     def get_message_info(self, channel_info, date_info, messages):
+        # permalink とユーザー名の解決
+        with self.stage('resolve'):
+            return  self.get_message_info_1(channel_info, date_info, messages)
+
+    def get_message_info_1(self, channel_info, date_info, messages):
         '''スレッド情報を取得する関数
         channel_info: チャンネルID
         messages: メッセージリスト
@@ -136,7 +377,8 @@ class SlackMessageChecker:
         info.date_info= date_info
 
         # スレッド情報を取得
-        info.thread_text= self.thread_to_text(messages)
+        info.message_text_list= [self.message_to_text(message) for message in messages]
+        info.thread_text= '\n'.join(info.message_text_list)
         info.header_text= self.message_to_text(messages[0])
         first_message= messages[0]
 
@@ -144,8 +386,8 @@ class SlackMessageChecker:
         thread_ts= first_message.get('thread_ts', None)
         if thread_ts is None:
             thread_ts= first_message.get('ts', None)
-        response= self.api.client.chat_getPermalink(channel=info.channel_id, message_ts=thread_ts)
-        info.thread_url= response.get('permalink','')
+        info.thread_ts= thread_ts
+        info.thread_url= self.api.get_permalink(info.channel_id, thread_ts)
 
 		# ポストしたユーザーの情報を取得
         info.post_user_info= self.api.get_user_info(first_message['user'])
@@ -164,10 +406,27 @@ class SlackMessageChecker:
         info.reply_users_text= ' '.join(reply_user_list)
         info.reply_users= len(reply_user_list)
         info.reply_count= first_message.get('reply_count', 0)
+        info.latest_ts= float(first_message.get('latest_reply', first_message.get('ts', '0')))
 
         self.api.save_cache()
         return  info
 
+    def get_deferred_info(self, channel_info, date_info, message):
+        # 持ち越すスレッドの情報  リプライやユーザー名の取得は行わず、キャッシュにあるものだけを使う
+        info= ThreadInfo()
+        info.deferred= True
+        info.channel_name, info.channel_id= channel_info
+        info.date_info= date_info
+        info.thread_ts= message.get('thread_ts', message.get('ts', None))
+        info.thread_url= self.api.get_permalink(info.channel_id, info.thread_ts, fetch=False)
+        info.post_user_info= self.api.get_user_info(message.get('user', 'Unknown'), fetch=False)
+        info.post_user_name= self.userinfo_to_string(info.post_user_info)
+        info.post_date= self.get_date_string(message.get('ts', '0'))
+        info.reply_date= self.get_date_string(message.get('latest_reply', '0'))
+        info.reply_count= message.get('reply_count', 0)
+        info.latest_ts= float(message.get('latest_reply', message.get('ts', '0')))
+        return  info
+
     def get_channels(self, summary_list):
         # チャンネル情報を取得
         channel_map= {}
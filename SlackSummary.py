@@ -3,7 +3,14 @@
 
 import os
 import sys
+import re
 import json
+import time
+import queue
+import threading
+import datetime
+import functools
+import concurrent.futures
 
 lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
@@ -11,6 +18,10 @@ if lib_path not in sys.path:
 import OllamaAPI4
 import SlackMessageChecker
 import SlackAPI
+import SummaryCache
+import SummaryJournal
+import RunMetrics
+import SummaryScheduler
 
 #------------------------------------------------------------------------------
 
@@ -19,6 +30,8 @@ import SlackAPI
 # {
 #   "token": "SLACK-API-TOKEN",
 #   "post_token": "SLACK-API-TOKEN",
+#   "slack_api_url": "https://slack.com/api/",
+#   "slack_rate_scale": 1.0,             # Slack API の rate limit に掛ける倍率 (ベンチマーク用)
 #   "recent_days": 1,
 #   "specified_days": 30,
 #   "target_channels": [ "general", "random" ],
@@ -26,10 +39,54 @@ import SlackAPI
 #   "system_prompt": "要約して",
 #   "Header_prompt": "数行にまとめて",
 #   "provider": "ollama",
-#   "ollama_host": "http://localhost:11434",
+#   "ollama_host": "http://localhost:11434",  # [ "http://host1:11434", "http://host2:11434" ] で複数ホストに振り分ける
 #   "model_name": "gemma3:12b",
-#   "cahce_file": "cache.json",
+#   "num_ctx": 16384,
+#   "ollama_timeout": 600,                # read timeout
+#   "ollama_connect_timeout": 10,
+#   "ollama_max_fail": 2,                # 連続で失敗したホストを外す
+#   "ollama_probe_interval": 30,         # 外したホストを確認する間隔 (秒)
+#   "llm_max_retry": 3,                  # 一時的なエラーの再試行回数
+#   "llm_retry_wait": 2.0,
+#   "llm_breaker_threshold": 5,          # 連続で失敗したら llm_breaker_cooldown 秒の間は LLM を呼ばない
+#   "llm_breaker_cooldown": 60,
+#   "keep_alive": "30m",                 # モデルをメモリに残す時間 (-1 で常駐)
+#   "preload_model": true,               # 開始時にモデルを読み込んでおく
+#   "prompt_system": true,               # 指示を system メッセージで渡す (false なら本文の前に連結)
+#   "streaming": true,                   # 逐次受信して TTFT を計測する
+#   "max_output_chars": 8000,            # streaming 時に暴走した出力を打ち切る (0 で無制限)
+#   "output_tokens": 2048,
+#   "chunk_tokens": 7168,
+#   "chunk_prompt": "スレッドの一部を要約して",
+#   "reduce_prompt": "部分要約をまとめて",
+#   "channel_digest": true,
+#   "digest_prompt": "チャンネルのスレッド要約をまとめて",
+#   "structured_output": true,           # 要約とヘッダを 1 回の呼び出しで JSON として生成する
+#   "structured_prompt": "～ {system_prompt} ～ {header_prompt}",
+#   "llm_concurrency": 1,
+#   "schedule": true,                    # 優先度の高いスレッドから要約する (time_budget 指定時は常に有効)
+#   "time_budget": 1800,                 # 開始からの秒数  間に合わないスレッドは要約せず次回に持ち越す
+#                                         # 過ぎた後はリプライやユーザー名も取得しない
+#   "carry_over_file": "carry_over.json",  # 持ち越したスレッドを記録し、次回は更新がなくても要約する
+#   "channel_weight": { "general": 2.0 },  # 優先度に掛けるチャンネルごとの重み
+#   "recency_half_life": 24,             # 最終更新からこの時間 (hour) ごとに優先度を半分にする
+#   "pipeline_queue_size": 2,
+#   "cahce_file": "cache.json",         # .db なら sqlite (cache.json から自動移行)
 #   "post_cahce_file": "cache.json",
+#   "archive_file": "archive.db",         # 指定時は crawl_state_file の代わりにこちらを使う
+#   "reply_refresh_hours": 168,          # archive のスレッドもこの時間ごとに全体を取り直して、リプライの編集や削除を反映する
+#                                         # 毎日実行する場合に 24 にすると実行時刻のずれで 1 日おきに全スレッドを取り直すので数日単位にする
+#   "crawl_state_file": "crawl_state.json",
+#   "thread_open_days": 7,                # 既定は specified_days (指定期間の履歴を毎回取り直す)  短くすると履歴の取得は減るが、
+#                                         # それより前に更新の止まったスレッドに付いた新しいリプライは見落とす
+#   "fetch_concurrency": 4,
+#   "user_sync_days": 7,
+#   "summary_cache_file": "summary_cache.json",
+#   "summary_cache_entries": 5000,
+#   "summary_cache_days": 30,
+#   "checkpoint_file": "checkpoint.jsonl",  # 要約済みスレッドを逐次記録し --resume で再開する
+#   "metrics_file": "metrics.json",        # 段階ごとの時間・API の応答時間・tokens/s・キャッシュヒット率
+#   "metrics_prom_file": "/var/lib/node_exporter/slack_summary.prom",  # Prometheus の textfile 形式
 #   "output_channel": "summary",
 #   "output_markdown": "output.md",
 #   "output_mention": ""
@@ -38,14 +95,25 @@ import SlackAPI
 #------------------------------------------------------------------------------
 
 class SlackSummary:
-    def __init__(self, config_file):
+    def __init__(self, config_file, offline=False, resume=False):
         config= self.load_config(config_file)
         self.config= config
+        if offline and config.get('archive_file', None) is None:
+            print("--offline requires archive_file in config.")
+            sys.exit(1)
+        if resume and not config.get('checkpoint_file', None):
+            print("--resume requires checkpoint_file in config.")
+            sys.exit(1)
         token= config.get('token', os.environ.get('SLACK_API_TOKEN'))
         if token is None:
             print("SLACK_API_TOKEN not found in environment variables.")
             return
-        self.slack_checker = SlackMessageChecker.SlackMessageChecker(token=token, cache=config.get('cache_file', 'cache.json'))
+        self.metrics= RunMetrics.RunMetrics()
+        self.metrics_file= config.get('metrics_file', None)
+        self.metrics_prom_file= config.get('metrics_prom_file', None)
+        # time_budget の締め切りで set する  取得側はリプライの取得と rate limit の待ちをやめる
+        self.defer_event= threading.Event()
+        self.slack_checker = SlackMessageChecker.SlackMessageChecker(token=token, cache=config.get('cache_file', 'cache.json'), crawl_state=config.get('crawl_state_file', None), open_days=config.get('thread_open_days', None), fetch_concurrency=config.get('fetch_concurrency', 1), user_sync_days=config.get('user_sync_days', 0), archive=config.get('archive_file', None), offline=offline, refresh_hours=config.get('reply_refresh_hours', 168), base_url=config.get('slack_api_url', None), metrics=self.metrics, stop_event=self.defer_event, rate_scale=config.get('slack_rate_scale', 1.0))
         self.recent_days= config.get('recent_days', 1)
         self.specified_days= config.get('specified_days', 7)
         self.target_channels= config.get('target_channels', [])
@@ -55,9 +123,51 @@ class SlackSummary:
         self.output_channel= config.get('output_channel', None)
         self.output_markdown= config.get('output_markdown', None)
         self.output_mention= config.get('output_mention', '')
-        options= OllamaAPI4.OllamaOptions(model=config['model_name'], base_url=config['ollama_host'], provider=config.get('provider', 'ollama'), num_ctx=16384)
+        # ollama_host に複数のホストを指定した場合は既定でホスト数だけ並列に要約する
+        host_list= config['ollama_host']
+        if isinstance(host_list, str):
+            host_list= host_list.split(',')
+        self.llm_concurrency= max(1, config.get('llm_concurrency', len(host_list)))
+        self.pipeline_queue_size= max(1, config.get('pipeline_queue_size', self.llm_concurrency * 2))
+        # 要約とチャンク要約のワーカーが同時に接続するので 2 倍のプールを用意する
+        options= OllamaAPI4.OllamaOptions(model=config['model_name'], base_url=host_list, provider=config.get('provider', 'ollama'), num_ctx=config.get('num_ctx', 16384),
+                timeout=config.get('ollama_timeout', 600), connect_timeout=config.get('ollama_connect_timeout', 10), pool_size=self.llm_concurrency * 2,
+                keep_alive=config.get('keep_alive', None), streaming=config.get('streaming', False), max_output_chars=config.get('max_output_chars', 0),
+                max_fail=config.get('ollama_max_fail', 2), probe_interval=config.get('ollama_probe_interval', 30),
+                max_retry=config.get('llm_max_retry', 3), retry_wait=config.get('llm_retry_wait', 2.0), breaker_threshold=config.get('llm_breaker_threshold', 5), breaker_cooldown=config.get('llm_breaker_cooldown', 60))
         self.ollama_api = OllamaAPI4.OllamaAPI(options)
+        self.prompt_system= config.get('prompt_system', True)
+        self.preload_model= config.get('preload_model', True)
+        # num_ctx から出力分を除いた量を超えるスレッドは分割して要約する
+        self.prompt_tokens= options.num_ctx - config.get('output_tokens', 2048)
+        self.chunk_tokens= config.get('chunk_tokens', self.prompt_tokens // 2)
+        self.chunk_prompt= config.get('chunk_prompt', '以下はslackのスレッドの一部です。内容を要約してください。')
+        self.reduce_prompt= config.get('reduce_prompt', '以下はslackの一連のスレッドを分割して要約したものです。スレッド全体の要約にまとめてください。')
+        self.chunk_executor= None
+        self.channel_digest= config.get('channel_digest', False)
+        self.digest_prompt= config.get('digest_prompt', '以下はslackのあるチャンネルで更新されたスレッドの要約一覧です。チャンネル全体の動きを数行でまとめてください。')
+        self.digest_map= {}
+        self.failed_list= []
+        self.deferred_list= []
+        self.time_budget= config.get('time_budget', 0)
+        self.schedule= config.get('schedule', False) or bool(self.time_budget)
+        self.channel_weight= config.get('channel_weight', {})
+        self.recency_half_life= config.get('recency_half_life', 24.0)
+        self.carry_over_file= config.get('carry_over_file', 'carry_over.json')
+        self.carry_set= set()
+        self.structured_output= config.get('structured_output', False)
+        self.structured_prompt= config.get('structured_prompt', '以下はslackの一連のスレッドを取り出したものです。次の2項目を持つ JSON を出力してください。\nsummary: {system_prompt}\nheader: スレッドの最初のメッセージについて、{header_prompt}')
+        self.structured_count= 0
+        self.fallback_count= 0
+        self.count_lock= threading.Lock()
         self.slack_api= None
+        self.resume= resume
+        self.journal= None
+        if config.get('checkpoint_file', None):
+            self.journal= SummaryJournal.SummaryJournal(config['checkpoint_file'])
+        self.summary_cache= None
+        if config.get('summary_cache_file', None):
+            self.summary_cache= SummaryCache.SummaryCache(config['summary_cache_file'], config.get('summary_cache_entries', 5000), config.get('summary_cache_days', 30))
 
     def load_config(self, config_file):
         # 設定ファイルを読み込む
@@ -76,35 +186,541 @@ class SlackSummary:
             return []
         return messages
 
-    def summarize_messages(self, messages):
-        # メッセージを要約する
+    def get_model_info(self):
+        options= self.ollama_api.options
+        return  (options.provider, options.model, options.num_ctx, options.temperature, options.top_k, options.top_p, options.min_p, options.remove_think, self.prompt_system)
+
+    def generate_prompt(self, prompt, text, schema=None):
+        # 指示を system に置いて先頭に固定し、スレッド間で共通の prefix をサーバーのプロンプトキャッシュに乗せる
+        if self.prompt_system:
+            return  self.ollama_api.generate(text, system=prompt, schema=schema)
+        return  self.ollama_api.generate(prompt + '\n' + text, schema=schema)
+
+    def get_summary_key(self, thread_info):
+        # スレッド本文・プロンプト・モデル設定が同じなら同じ要約になる
+        model_info= self.get_model_info()
+        if self.is_large_thread(thread_info):
+            model_info+= (self.chunk_tokens, self.chunk_prompt, self.reduce_prompt)
+        elif self.structured_output:
+            model_info+= (self.structured_prompt,)
+        return  self.summary_cache.make_key(model_info, self.system_prompt, self.header_prompt, thread_info.thread_text, thread_info.header_text)
+
+    def estimate_tokens(self, text):
+        # 日本語は 1 文字 (utf-8 で 3 byte) がおよそ 1 token、英語は 4 文字程度で 1 token
+        return  len(text.encode('utf-8')) // 3 + 1
+
+    def is_large_thread(self, thread_info):
+        return  self.estimate_tokens(self.system_prompt + '\n' + thread_info.thread_text) > self.prompt_tokens
+
+    def split_chunks(self, text_list, chunk_tokens):
+        # メッセージ単位で chunk_tokens 以下にまとめる  1 メッセージで超える場合は文字数で分ける
+        chunk_list= []
+        current_list= []
+        current_tokens= 0
+        for text in text_list:
+            tokens= self.estimate_tokens(text)
+            if tokens > chunk_tokens:
+                step= max(1, len(text) * chunk_tokens // tokens)
+                piece_list= [text[i:i+step] for i in range(0, len(text), step)]
+            else:
+                piece_list= [text]
+            for piece in piece_list:
+                tokens= self.estimate_tokens(piece)
+                if current_list != [] and current_tokens + tokens > chunk_tokens:
+                    chunk_list.append('\n'.join(current_list))
+                    current_list= []
+                    current_tokens= 0
+                current_list.append(piece)
+                current_tokens+= tokens
+        if current_list != []:
+            chunk_list.append('\n'.join(current_list))
+        return  chunk_list
+
+    def generate_chunk(self, chunk):
+        return  self.generate_prompt(self.chunk_prompt, chunk)
+
+    def truncate_text(self, text, max_tokens):
+        # 推定 token 数が max_tokens 以下になるように末尾を切り詰める
+        tokens= self.estimate_tokens(text)
+        if tokens <= max_tokens:
+            return  text
+        return  text[:max(1, len(text) * max_tokens // tokens)]
+
+    def generate_thread_summary(self, text_list, prompt, depth=0):
+        # 収まる場合はそのまま 1 回で要約し、収まらない場合は分割要約 (map) をまとめる (reduce)
+        #  reduce では reduce_prompt に元の指示 (system_prompt など) を続けて渡す
+        #  収まるまで reduce を繰り返し、要約しても短くならない場合だけ上限で切り詰める
+        step_prompt= prompt
+        if depth > 0:
+            step_prompt= self.reduce_prompt + '\n' + prompt
+        text= '\n'.join(text_list)
+        if self.estimate_tokens(step_prompt + '\n' + text) <= self.prompt_tokens:
+            return  self.generate_prompt(step_prompt, text)
+        chunk_list= self.split_chunks(text_list, self.chunk_tokens)
+        print('    split %d chunks' % len(chunk_list), flush=True)
+        if self.chunk_executor is not None:
+            result_list= list(self.chunk_executor.map(self.generate_chunk, chunk_list))
+        else:
+            result_list= [self.generate_chunk(chunk) for chunk in chunk_list]
         summary_list= []
-        for index,item in enumerate(messages):
-            channel_info= item.get('channel', None)
-            date_info= item.get('date', None)
-            reply_list= item.get('messages', [])
-            thread_info = self.slack_checker.get_message_info(channel_info, date_info, reply_list)
-            # bot user を無視
-            post_user_info= thread_info.post_user_info
-            post_user_id= post_user_info.get('id','<None>')
-            post_user_name= post_user_info.get('real',post_user_info.get('user','<None>'))
-            if post_user_name in self.bot_users:
-                print( 'skip: bot user', post_user_name )
-                continue
-            print('  %d/%d %s' % (index+1, len(messages), thread_info.reply_date), flush=True)
-            summary,status_code = self.ollama_api.generate(self.system_prompt + '\n' + thread_info.thread_text)
+        for summary,status_code in result_list:
             if status_code != 200:
-                print(f"Error generating summary: {status_code}")
+                return  summary,status_code
+            summary_list.append(summary)
+        if self.estimate_tokens('\n'.join(summary_list)) >= self.estimate_tokens(text):
+            print('    summary does not shrink, truncated', flush=True)
+            reduce_prompt= self.reduce_prompt + '\n' + prompt
+            max_tokens= max(1, self.prompt_tokens - self.estimate_tokens(reduce_prompt + '\n'))
+            return  self.generate_prompt(reduce_prompt, self.truncate_text('\n'.join(summary_list), max_tokens))
+        return  self.generate_thread_summary(summary_list, prompt, depth+1)
+
+    SUMMARY_SCHEMA= {
+        'type': 'object',
+        'properties': {
+            'summary': {'type': 'string'},
+            'header': {'type': 'string'},
+        },
+        'required': ['summary', 'header'],
+        'additionalProperties': False,
+    }
+
+    def parse_structured(self, response):
+        # JSON 以外が混ざった場合に備えてコードブロックや前後の文字列を取り除く
+        match= re.search(r'\{.*\}', response, flags=re.DOTALL)
+        if match is None:
+            return  None
+        try:
+            data= json.loads(match.group(0))
+        except ValueError:
+            return  None
+        if not isinstance(data, dict):
+            return  None
+        summary= data.get('summary', None)
+        header= data.get('header', None)
+        if not isinstance(summary, str) or not isinstance(header, str) or summary.strip() == '' or header.strip() == '':
+            return  None
+        return  summary,header
+
+    def generate_structured(self, thread_info):
+        # 要約とヘッダを 1 回の呼び出しで生成する  失敗したら None を返して 2 回呼び出しに戻す
+        prompt= self.structured_prompt.format(system_prompt=self.system_prompt, header_prompt=self.header_prompt)
+        response,status_code= self.generate_prompt(prompt, thread_info.thread_text, schema=self.SUMMARY_SCHEMA)
+        if status_code != 200:
+            # 400 は schema 未対応の可能性があるので 2 回呼び出しで再試行し、以降は structured output を使わない
+            if status_code == 400:
+                if self.structured_output:
+                    print('    structured output rejected (400), disabled', flush=True)
+                    self.structured_output= False
+                return  None
+            return  status_code
+        result= self.parse_structured(response)
+        if result is None:
+            return  None
+        thread_info.summary,thread_info.header= result
+        return  status_code
+
+    def generate_summary(self, thread_info):
+        # 1スレッド分の要約とヘッダを生成する (ワーカースレッドで実行)
+        with self.metrics.stage('generate'):
+            return  self.generate_summary_1(thread_info)
+
+    def generate_summary_1(self, thread_info):
+        if self.structured_output and not self.is_large_thread(thread_info):
+            status_code= self.generate_structured(thread_info)
+            if status_code is not None:
+                if status_code == 200:
+                    with self.count_lock:
+                        self.structured_count+= 1
+                return  status_code
+            print('    structured output failed, fallback', flush=True)
+            with self.count_lock:
+                self.fallback_count+= 1
+        text_list= getattr(thread_info, 'message_text_list', [thread_info.thread_text])
+        summary,status_code = self.generate_thread_summary(text_list, self.system_prompt)
+        if status_code != 200:
+            return  status_code
+        header,status_code = self.generate_prompt(self.header_prompt, thread_info.header_text)
+        if status_code != 200:
+            return  status_code
+        thread_info.summary= summary
+        thread_info.header= header
+        return  status_code
+
+    def start_summary(self, executor, index, item):
+        # スレッド情報を取得して要約ジョブを投入する
+        job= self.prepare_summary(index, item)
+        if job is None:
+            return  None
+        index,thread_info,summary_key,need_summary= job
+        future= None
+        if need_summary:
+            future= executor.submit(self.generate_summary, thread_info)
+        return  (index, thread_info, summary_key, future)
+
+    def schedule_summary(self, scheduler, put_job, index, item):
+        # スレッド情報を取得し、要約が必要なら scheduler に渡す  不要ならそのまま put_job で出力に回す
+        job= self.prepare_summary(index, item)
+        if job is None:
+            return
+        index,thread_info,summary_key,need_summary= job
+        if not need_summary:
+            put_job((index, thread_info, summary_key, None))
+            return
+        if getattr(thread_info, 'deferred', False):
+            scheduler.defer((index, thread_info, summary_key))
+            return
+        priority= scheduler.get_priority(thread_info.channel_name, thread_info.reply_count, thread_info.latest_ts)
+        scheduler.add((index, thread_info, summary_key), priority, self.estimate_tokens(self.system_prompt + '\n' + thread_info.thread_text))
+
+    def prepare_summary(self, index, item):
+        # スレッド情報を取得する
+        #  return: (index, thread_info, summary_key, 要約が必要か)  bot user なら None
+        channel_info= item.get('channel', None)
+        date_info= item.get('date', None)
+        reply_list= item.get('messages', [])
+        # checkpoint に記録済みのスレッドはそのまま使う
+        if self.journal and channel_info is not None:
+            thread= self.journal.get_thread(channel_info[1], reply_list[0].get('ts', '0'))
+            if thread is not None:
+                thread_info= SlackMessageChecker.ThreadInfo()
+                thread_info.__dict__.update(thread)
+                return  (index, thread_info, None, False)
+        deferred= item.get('deferred', False)
+        if deferred:
+            # 締め切りを過ぎて取得を打ち切ったスレッドはリプライがないので要約せずに持ち越す
+            thread_info= self.slack_checker.get_deferred_info(channel_info, date_info, reply_list[0])
+        else:
+            try:
+                thread_info = self.slack_checker.get_message_info(channel_info, date_info, reply_list)
+            except SlackAPI.SlackRequestCancelled:
+                # 締め切りでユーザー名や permalink の取得が打ち切られた
+                deferred= True
+                thread_info= self.slack_checker.get_deferred_info(channel_info, date_info, reply_list[0])
+        # bot user を無視
+        post_user_info= thread_info.post_user_info
+        post_user_id= post_user_info.get('id','<None>')
+        post_user_name= post_user_info.get('real',post_user_info.get('user','<None>'))
+        if post_user_name in self.bot_users:
+            print( 'skip: bot user', post_user_name )
+            return  None
+        if deferred:
+            return  (index, thread_info, None, True)
+        # キャッシュにあれば LLM を呼ばない
+        summary_key= None
+        if self.summary_cache:
+            summary_key= self.get_summary_key(thread_info)
+            cached= self.summary_cache.get(summary_key)
+            if cached:
+                thread_info.summary= cached['summary']
+                thread_info.header= cached['header']
+                return  (index, thread_info, summary_key, False)
+        return  (index, thread_info, summary_key, True)
+
+    def finish_summary(self, job):
+        # 要約ジョブの完了を待つ  失敗したら failed_list に記録して None
+        #  index は見つかった順  schedule 時に完了順で届いても出力をこの順に並べ直す
+        index,thread_info,summary_key,future= job
+        thread_info.index= index
+        if future is not None:
+            try:
+                status_code= future.result()
+            except Exception as e:
+                print(f"Error generating summary: {e}")
+                thread_info.error= str(e)
+                self.failed_list.append(thread_info)
                 return  None
-            header,status_code = self.ollama_api.generate(self.header_prompt + '\n' + thread_info.header_text)
             if status_code != 200:
                 print(f"Error generating summary: {status_code}")
+                thread_info.error= 'status %d' % status_code
+                self.failed_list.append(thread_info)
                 return  None
-            thread_info.summary= summary
-            thread_info.header= header
-            summary_list.append(thread_info)
+            if summary_key:
+                self.summary_cache.set(summary_key, {'summary': thread_info.summary, 'header': thread_info.header})
+        if self.journal and self.journal.get_thread(thread_info.channel_id, thread_info.thread_ts) is None:
+            self.journal.add_thread(thread_info.channel_id, thread_info.thread_ts, thread_info.__dict__)
+        print('  %d %s' % (index+1, thread_info.reply_date), flush=True)
+        return  thread_info
+
+    def generate_digest(self, thread_list):
+        # チャンネル内のスレッド要約からチャンネル単位のまとめを作る (ワーカースレッドで実行)
+        text_list= []
+        for thread_info in thread_list:
+            text= '* %s\n' % thread_info.header
+            if thread_info.reply_count > 0:
+                text+= thread_info.summary + '\n'
+            text_list.append(text)
+        with self.metrics.stage('digest'):
+            return  self.generate_thread_summary(text_list, self.digest_prompt)
+
+    def start_digest(self, executor, thread_list):
+        # 生成済みの要約だけを使うので LLM 呼び出しはチャンネルごとに 1 回
+        channel_name= thread_list[0].channel_name
+        digest_key= None
+        if self.summary_cache:
+            digest_key= self.summary_cache.make_key('digest', self.get_model_info(), self.chunk_tokens, self.reduce_prompt, self.digest_prompt,
+                    [(thread_info.header, thread_info.summary) for thread_info in thread_list])
+            cached= self.summary_cache.get(digest_key)
+            if cached:
+                return  (channel_name, digest_key, None, cached['digest'])
+        return  (channel_name, digest_key, executor.submit(self.generate_digest, thread_list), None)
+
+    def finish_digests(self, digest_job_list):
+        self.digest_map= {}
+        for channel_name,digest_key,future,digest in digest_job_list:
+            if future is not None:
+                try:
+                    digest,status_code= future.result()
+                except Exception as e:
+                    print(f"Error generating digest: {e}")
+                    continue
+                if status_code != 200:
+                    print(f"Error generating digest: {status_code}")
+                    continue
+                if digest_key:
+                    self.summary_cache.set(digest_key, {'digest': digest})
+            self.digest_map[channel_name]= digest
+
+    def group_channels(self, summary_list):
+        channel_map= {}
+        for thread_info in summary_list:
+            channel_map.setdefault(thread_info.channel_name, []).append(thread_info)
+        return  list(channel_map.values())
+
+    def run_pipeline(self, messages, sink_list=[]):
+        # 取得 → 要約 → 出力 を並行して行う
+        #  取得スレッドが要約ジョブを投入し、メインスレッドが投入順に完了を待って出力する
+        #  schedule 時は取得したジョブを scheduler に溜め、空いたワーカーに優先度順に投入して完了順に出力する
+        job_queue= queue.Queue(maxsize=self.pipeline_queue_size)
+        stop_event= threading.Event()
+        fetch_error= []
+        summary_list= []
+        self.failed_list= []
+        self.deferred_list= []
+        digest_job_list= []
+        channel_thread_list= []
+        scheduler= None
+        defer_timer= None
+        self.defer_event.clear()
+        if self.schedule:
+            scheduler= SummaryScheduler.SummaryScheduler(self.time_budget, self.channel_weight, self.recency_half_life)
+            if scheduler.deadline is not None:
+                # 締め切りを過ぎたら取得側も残りのスレッドのリプライを取得せずに持ち越す
+                defer_timer= threading.Timer(scheduler.get_remaining(), self.defer_event.set)
+                defer_timer.daemon= True
+                defer_timer.start()
+
+        def put_job(job):
+            # メインスレッドが止まった後は待たずに捨てる
+            while not stop_event.is_set():
+                try:
+                    job_queue.put(job, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def fetch_thread(executor):
+            start_time= time.perf_counter()
+            try:
+                for index,item in enumerate(messages):
+                    if stop_event.is_set():
+                        break
+                    if scheduler is not None:
+                        self.schedule_summary(scheduler, put_job, index, item)
+                        continue
+                    job= self.start_summary(executor, index, item)
+                    if job is not None:
+                        put_job(job)
+            except Exception as e:
+                fetch_error.append(e)
+            finally:
+                # 途中で止めた場合も取得側の後始末 (executor の停止やキャッシュの保存) を行う
+                close= getattr(messages, 'close', None)
+                if close is not None:
+                    close()
+                self.metrics.set('fetch_seconds', time.perf_counter() - start_time)
+                if scheduler is not None:
+                    scheduler.close()
+                else:
+                    put_job(None)
+
+        def finish_job(slots, job, tokens, start_time, future):
+            try:
+                scheduler.record(tokens, time.monotonic() - start_time)
+                put_job(job + (future,))
+            finally:
+                slots.release()
+
+        def dispatch_thread(executor):
+            slots= threading.Semaphore(self.llm_concurrency)
+            try:
+                while True:
+                    slots.acquire()
+                    job,tokens= scheduler.pop()
+                    if job is None or stop_event.is_set():
+                        break
+                    future= executor.submit(self.generate_summary, job[1])
+                    future.add_done_callback(functools.partial(finish_job, slots, job, tokens, time.monotonic()))
+                # 実行中のジョブの完了を待つ
+                for slot in range(self.llm_concurrency - 1):
+                    slots.acquire()
+            finally:
+                put_job(None)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.llm_concurrency) as executor, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=self.llm_concurrency) as chunk_executor:
+                self.chunk_executor= chunk_executor
+                if self.preload_model:
+                    # Slack の取得中にモデルの読み込みを済ませておく
+                    executor.submit(self.ollama_api.preload)
+                thread_list= [threading.Thread(target=fetch_thread, args=(executor,), daemon=True)]
+                if scheduler is not None:
+                    thread_list.append(threading.Thread(target=dispatch_thread, args=(executor,), daemon=True))
+                for thread in thread_list:
+                    thread.start()
+                try:
+                    while True:
+                        job= job_queue.get()
+                        if job is None:
+                            break
+                        thread_info= self.finish_summary(job)
+                        if thread_info is None:
+                            continue
+                        summary_list.append(thread_info)
+                        with self.metrics.stage('publish'):
+                            for sink in sink_list:
+                                sink.add(thread_info)
+                        # チャンネルが切り替わったら前のチャンネルのまとめを作り始める
+                        if self.channel_digest and scheduler is None:
+                            if channel_thread_list != [] and channel_thread_list[0].channel_name != thread_info.channel_name:
+                                digest_job_list.append(self.start_digest(executor, channel_thread_list))
+                                channel_thread_list= []
+                            channel_thread_list.append(thread_info)
+                except BaseException:
+                    # 例外や Ctrl-C で抜ける場合は取得と投入を止め、未実行の要約を取り消してから終了を待つ
+                    stop_event.set()
+                    if scheduler is not None:
+                        scheduler.close()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                finally:
+                    for thread in thread_list:
+                        thread.join()
+                if scheduler is not None:
+                    self.deferred_list= [job[1] for job in sorted(scheduler.get_deferred(), key=lambda job: job[0])]
+                    if self.deferred_list:
+                        print('* time budget exceeded: %d threads deferred' % len(self.deferred_list), flush=True)
+                    # 完了順に並ぶので見つかった順に戻し、まとめは最後にチャンネルごとに作る  締め切りに間に合わないものは作らない
+                    summary_list.sort(key=lambda thread_info: thread_info.index)
+                    if self.channel_digest:
+                        for thread_list in self.group_channels(summary_list):
+                            if scheduler.is_feasible(self.estimate_tokens(''.join(thread_info.header + thread_info.summary for thread_info in thread_list))):
+                                digest_job_list.append(self.start_digest(executor, thread_list))
+                elif channel_thread_list != []:
+                    digest_job_list.append(self.start_digest(executor, channel_thread_list))
+                self.finish_digests(digest_job_list)
+            with self.metrics.stage('publish'):
+                for sink in sink_list:
+                    sink.close()
+        finally:
+            if defer_timer is not None:
+                defer_timer.cancel()
+            self.chunk_executor= None
+            if self.summary_cache:
+                self.summary_cache.save_cache()
+        if fetch_error:
+            raise fetch_error[0]
+        self.save_carry_over()
         return  summary_list
 
+    def load_carry_over(self):
+        # 前回持ち越したスレッド (channel_id, ts)
+        if not self.carry_over_file:
+            return  set()
+        data= SlackAPI.load_json(self.carry_over_file)
+        if not data:
+            return  set()
+        return  set((channel_id, ts) for channel_id,ts in data.get('threads', []))
+
+    def save_carry_over(self):
+        # 持ち越したスレッドを次回の取得対象に加える  要約できたものは外れる
+        if not self.carry_over_file:
+            return
+        if not self.deferred_list and not os.path.exists(self.carry_over_file):
+            return
+        # 履歴を取得できなかったチャンネルの持ち越しは残す
+        thread_list= [[channel_id, ts] for channel_id,ts in sorted(self.carry_set) if channel_id not in self.slack_checker.crawled_channel_set]
+        thread_list+= [[thread_info.channel_id, thread_info.thread_ts] for thread_info in self.deferred_list]
+        SlackAPI.save_json(self.carry_over_file, {'threads': thread_list})
+
+    def iter_recent_messages(self):
+        # checkpoint があれば前回と同じ期間で取得し、記録済みのスレッドはリプライを取得しない
+        today_date= None
+        skip_set= None
+        if self.journal:
+            run_info= {'today': time.time(), 'recent_days': self.recent_days, 'specified_days': self.specified_days, 'target_channels': self.target_channels}
+            today_date= datetime.datetime.fromtimestamp(self.journal.start(run_info, self.resume))
+            skip_set= self.journal.get_skip_set()
+        self.carry_set= self.load_carry_over()
+        return  self.slack_checker.iter_recent_messages(self.recent_days, self.specified_days, self.target_channels, today_date, skip_set, self.carry_set)
+
+    def summarize_messages(self, messages):
+        # メッセージを要約する
+        return  self.run_pipeline(messages)
+
+    def print_stats(self):
+        if self.failed_list:
+            print('* failed threads: %d' % len(self.failed_list), flush=True)
+            for thread_info in self.failed_list:
+                print('  #%s %s %s (%s)' % (thread_info.channel_name, thread_info.post_date, thread_info.thread_url, thread_info.error), flush=True)
+        if self.deferred_list:
+            print('* deferred threads: %d' % len(self.deferred_list), flush=True)
+        if len(self.ollama_api.router.endpoint_list) > 1:
+            print('* endpoints:\n' + self.ollama_api.router.get_stats_text(), end='', flush=True)
+        count,average,max_time= self.ollama_api.get_ttft_stats()
+        if count:
+            print('* ttft: avg %.2f sec, max %.2f sec (%d)' % (average, max_time, count), flush=True)
+        if self.structured_output or self.fallback_count:
+            print('* structured output: %d, fallback: %d' % (self.structured_count, self.fallback_count), flush=True)
+        if self.summary_cache:
+            print('* summary cache: %s' % self.summary_cache.get_stats_text(), flush=True)
+        stats= self.ollama_api.get_eval_stats()
+        if stats['eval_duration'] > 0:
+            print('* eval: %.1f tokens/s, prompt: %.1f tokens/s (%d requests)' % (stats['eval_tokens_per_sec'], stats['prompt_tokens_per_sec'], stats['requests']), flush=True)
+        stage_text= self.metrics.get_stage_text()
+        if stage_text != '':
+            print('* stages:\n' + stage_text, end='', flush=True)
+
+    def save_metrics(self, summary_list, run_time):
+        # 実行の最後に LLM とキャッシュの集計を加えて書き出す
+        if self.metrics_file is None and self.metrics_prom_file is None:
+            return
+        metrics= self.metrics
+        metrics.set('run_seconds', run_time)
+        metrics.set('threads', len(summary_list))
+        metrics.set('failed_threads', len(self.failed_list))
+        metrics.set('deferred_threads', len(self.deferred_list))
+        stats= self.ollama_api.get_eval_stats()
+        metrics.set('llm_requests', stats['requests'])
+        metrics.set('llm_prompt_tokens', stats['prompt_eval_count'])
+        metrics.set('llm_eval_tokens', stats['eval_count'])
+        metrics.set('llm_prompt_tokens_per_second', stats['prompt_tokens_per_sec'])
+        metrics.set('llm_eval_tokens_per_second', stats['eval_tokens_per_sec'])
+        count,average,max_time= self.ollama_api.get_ttft_stats()
+        if count:
+            metrics.set('llm_ttft_seconds', average, stat='avg')
+            metrics.set('llm_ttft_seconds', max_time, stat='max')
+        if self.structured_output or self.fallback_count:
+            metrics.set('structured_output', self.structured_count, result='ok')
+            metrics.set('structured_output', self.fallback_count, result='fallback')
+        if self.summary_cache:
+            metrics.add('cache_requests_total', self.summary_cache.hit_count, cache='summary', result='hit')
+            metrics.add('cache_requests_total', self.summary_cache.miss_count, cache='summary', result='miss')
+        if self.metrics_file:
+            metrics.save_json(self.metrics_file, {'model': self.ollama_api.options.model, 'channels': self.target_channels})
+        if self.metrics_prom_file:
+            metrics.save_prometheus(self.metrics_prom_file)
+
     def output_text(self, output_file, summary_list):
         # テキスト形式で出力
         with open(output_file, 'w', encoding='utf-8') as fo:
@@ -122,51 +738,77 @@ class SlackSummary:
                 fo.write(thread_info.summary)
                 fo.write('\n\n')
 
-    def output_md(self, output_file, summary_list):
-        # Markdown形式で出力
-        with open(output_file, 'w', encoding='utf-8') as fo:
-            if len(summary_list) != 0:
-                date_info= summary_list[0].date_info
-                fo.write('# SlackSummary %s\n' % date_info[0])
-                fo.write('* 調査日時:  %s\n' % date_info[0])
-                fo.write('* 新規判定:  %s  以降の投稿やリプライがある場合\n' % date_info[2])
-                fo.write('* 検索範囲:  %s ～ %s\n' % (date_info[1][0:10],date_info[0][0:10]))
-                fo.write('* 更新スレッド数:  %d\n' % len(summary_list))
-            else:
-                fo.write('# SlackSummary\n')
-                fo.write('* 更新スレッドなし\n')
-            for thread_info in summary_list:
-                if thread_info.reply_count > 0:
-                    fo.write('## #%s  最終更新 %s %s\n' % (thread_info.channel_name, thread_info.reply_user_name, thread_info.reply_date))
-                else:
-                    fo.write('## #%s  投稿者 %s %s\n' % (thread_info.channel_name, thread_info.post_user_name, thread_info.post_date))
-                fo.write('\n')
-                fo.write('%s\n' % thread_info.header)
-                fo.write('\n')
-                fo.write('%s\n' % thread_info.thread_url)
+    def get_md_failed(self):
+        text= ''
+        if self.failed_list:
+            text+= '\n## 要約できなかったスレッド\n\n'
+            for thread_info in self.failed_list:
+                text+= '* #%s  投稿者 %s  %s  %s  (%s)\n' % (thread_info.channel_name, thread_info.post_user_name, thread_info.post_date, thread_info.thread_url, thread_info.error)
+        if self.deferred_list:
+            text+= '\n## 時間内に要約できなかったスレッド%s\n\n' % (' (次回に持ち越し)' if self.carry_over_file else '')
+            for thread_info in self.deferred_list:
+                text+= '* #%s  投稿者 %s  %s  %s\n' % (thread_info.channel_name, thread_info.post_user_name, thread_info.post_date, thread_info.thread_url)
+        return  text
 
-                if thread_info.reply_count > 0:
-                    fo.write('\n')
-                    fo.write('### 要約\n')
-                    fo.write(thread_info.summary)
-                    fo.write('\n\n')
-                else:
-                    fo.write('* リプライなし\n')
-                    fo.write('\n')
+    def get_md_header(self, summary_list):
+        text= ''
+        if len(summary_list) != 0 or self.failed_list or self.deferred_list:
+            date_info= (summary_list + self.failed_list + self.deferred_list)[0].date_info
+            text+= '# SlackSummary %s\n' % date_info[0]
+            text+= '* 調査日時:  %s\n' % date_info[0]
+            text+= '* 新規判定:  %s  以降の投稿やリプライがある場合\n' % date_info[2]
+            text+= '* 検索範囲:  %s ～ %s\n' % (date_info[1][0:10],date_info[0][0:10])
+            text+= '* 更新スレッド数:  %d\n' % len(summary_list)
+            if self.digest_map:
+                text+= '\n## チャンネル別まとめ\n\n'
+                for channel_name in self.digest_map:
+                    text+= '### #%s\n\n%s\n\n' % (channel_name, self.digest_map[channel_name])
+            text+= self.get_md_failed()
+        else:
+            text+= '# SlackSummary\n'
+            text+= '* 更新スレッドなし\n'
+        return  text
 
-                fo.write(    '|                    |          |\n')
-                fo.write(    '|:------------------ |:-------- |\n')
-                fo.write(    '| チャンネル         | #%s (%s) |\n' % (thread_info.channel_name, thread_info.channel_id) )
-                fo.write(    '| 投稿者             | %s       |\n' % thread_info.post_user_name)
-                fo.write(    '| 投稿日時           | %s       |\n' % thread_info.post_date)
-                if thread_info.reply_count > 0:
-                    fo.write('| リプライ数         | %d       |\n' % thread_info.reply_count)
-                    fo.write('| 参加者             | %s       |\n' % thread_info.reply_users_text)
-                    fo.write('| 最終リプライ投稿者 | %s       |\n' % thread_info.reply_user_name)
-                    fo.write('| 最終リプライ日時   | %s       |\n' % thread_info.reply_date)
+    def get_md_thread(self, thread_info):
+        text= ''
+        if thread_info.reply_count > 0:
+            text+= '## #%s  最終更新 %s %s\n' % (thread_info.channel_name, thread_info.reply_user_name, thread_info.reply_date)
+        else:
+            text+= '## #%s  投稿者 %s %s\n' % (thread_info.channel_name, thread_info.post_user_name, thread_info.post_date)
+        text+= '\n'
+        text+= '%s\n' % thread_info.header
+        text+= '\n'
+        text+= '%s\n' % thread_info.thread_url
 
-                fo.write('\n\n')
-            fo.write( '\n' )
+        if thread_info.reply_count > 0:
+            text+= '\n'
+            text+= '### 要約\n'
+            text+= thread_info.summary
+            text+= '\n\n'
+        else:
+            text+= '* リプライなし\n'
+            text+= '\n'
+
+        text+=     '|                    |          |\n'
+        text+=     '|:------------------ |:-------- |\n'
+        text+=     '| チャンネル         | #%s (%s) |\n' % (thread_info.channel_name, thread_info.channel_id)
+        text+=     '| 投稿者             | %s       |\n' % thread_info.post_user_name
+        text+=     '| 投稿日時           | %s       |\n' % thread_info.post_date
+        if thread_info.reply_count > 0:
+            text+= '| リプライ数         | %d       |\n' % thread_info.reply_count
+            text+= '| 参加者             | %s       |\n' % thread_info.reply_users_text
+            text+= '| 最終リプライ投稿者 | %s       |\n' % thread_info.reply_user_name
+            text+= '| 最終リプライ日時   | %s       |\n' % thread_info.reply_date
+
+        text+= '\n\n'
+        return  text
+
+    def output_md(self, output_file, summary_list):
+        # Markdown形式で出力
+        sink= MarkdownSink(self, output_file)
+        for thread_info in summary_list:
+            sink.add(thread_info)
+        sink.close()
 
     def get_slack_text(self, thread_info ):
         text= ''
@@ -201,21 +843,22 @@ class SlackSummary:
         text+=  ('\n　\n')
         return text
 
-    def send_slack_thread(self, slack_channel, summary_list):
-        # Slackにスレッドを送信
-        text= self.output_mention + '\n'
-        if len(summary_list) != 0:
-            channels= self.slack_checker.get_channels(summary_list)
-            date_info= summary_list[0].date_info
-            text= ('*SlackSummary %s*\n' % date_info[0])
-            #text+= ('%s 以降の更新\n' % date_info[2])
-            #text+= ('検索期間:  %s ～ %s\n' % (date_info[1][0:10],date_info[0][0:10]))
-            text+= ('%s\n' % channels)
-            text+= ('スレッド合計:  %d\n' % len(summary_list))
-        else:
-            text= ('*SlackSummary*\n')
-            text+= ('更新スレッドはありません\n')
-            return  None
+    def get_slack_parent_text(self, summary_list):
+        channels= self.slack_checker.get_channels(summary_list)
+        date_info= (summary_list + self.failed_list + self.deferred_list)[0].date_info
+        text= ('*SlackSummary %s*\n' % date_info[0])
+        #text+= ('%s 以降の更新\n' % date_info[2])
+        #text+= ('検索期間:  %s ～ %s\n' % (date_info[1][0:10],date_info[0][0:10]))
+        text+= ('%s\n' % channels)
+        text+= ('スレッド合計:  %d\n' % len(summary_list))
+        if self.failed_list:
+            text+= ('要約失敗:  %d\n' % len(self.failed_list))
+            for thread_info in self.failed_list[:20]:
+                text+= ('<%s|#%s %s>\n' % (thread_info.thread_url, thread_info.channel_name, thread_info.post_date))
+        if self.deferred_list:
+            text+= ('%s:  %d\n' % ('持ち越し' if self.carry_over_file else '時間切れ', len(self.deferred_list)))
+            for thread_info in self.deferred_list[:20]:
+                text+= ('<%s|#%s %s>\n' % (thread_info.thread_url, thread_info.channel_name, thread_info.post_date))
         blocks= [
             {
                 'type': 'section',
@@ -226,63 +869,88 @@ class SlackSummary:
                 }
             },
         ]
+        for channel_name in self.digest_map:
+            # section の text は 3000 文字まで
+            digest_text= '*#%s*\n%s' % (channel_name, self.digest_map[channel_name])
+            blocks.append({
+                'type': 'section',
+                'expand': True,
+                'text': {
+                    'type': 'mrkdwn',
+                    'text': digest_text[:3000]
+                }
+            })
+            text+= '\n' + digest_text + '\n'
+        return  text,blocks
+
+    def send_slack_thread(self, slack_channel, summary_list):
+        # Slackにスレッドを送信
+        if len(summary_list) == 0 and not self.failed_list and not self.deferred_list:
+            return  None
+        text,blocks= self.get_slack_parent_text(summary_list)
         response= self.slack_api.post_message(slack_channel, text=text, blocks=blocks)
         return response
 
-    def output_slack_v1(self, slack_channel, summary_list):
-        response= self.send_slack_thread(slack_channel, summary_list)
-        if response is None:
-            return
+    def update_slack_thread(self, slack_channel, parent_response, summary_list):
+        # 親メッセージのチャンネル一覧とスレッド数を最終値に更新
+        text,blocks= self.get_slack_parent_text(summary_list)
+        return  self.slack_api.update_message(slack_channel, parent_response.get('ts', None), text=text, blocks=blocks)
 
-        for thread_info in summary_list:
-            header_text= ''
-            if thread_info.reply_count > 0:
-                title_text=  ('🔴 更新 %s %s\n' % (thread_info.reply_user_name, thread_info.reply_date))
-                header_text= '*%s %s*\n' % (thread_info.post_user_name, thread_info.post_date)
-            else:
-                title_text=  ('🔵 新規 %s %s\n' % (thread_info.post_user_name, thread_info.post_date))
-            header_text+= thread_info.header
-            blocks= [
-                {
-                    'type': 'header',
-                    'text': {
-                        'type': 'plain_text',
-                        'text': title_text,
-                        'emoji': True
-                    }
-                },
+    def post_slack_thread_v1(self, slack_channel, thread_info, response):
+        header_text= ''
+        if thread_info.reply_count > 0:
+            title_text=  ('🔴 更新 %s %s\n' % (thread_info.reply_user_name, thread_info.reply_date))
+            header_text= '*%s %s*\n' % (thread_info.post_user_name, thread_info.post_date)
+        else:
+            title_text=  ('🔵 新規 %s %s\n' % (thread_info.post_user_name, thread_info.post_date))
+        header_text+= thread_info.header
+        blocks= [
+            {
+                'type': 'header',
+                'text': {
+                    'type': 'plain_text',
+                    'text': title_text,
+                    'emoji': True
+                }
+            },
+            {
+                'type': 'divider'
+            },
+            {
+                'type': 'section',
+                'text': {
+                    'type': 'mrkdwn',
+                    'text': '<%s|元スレッドのリンク(%d)>   #%s' % (thread_info.thread_url, thread_info.reply_count, thread_info.channel_name)
+                }
+            },
+            {
+                'type': 'section',
+                'expand': True,
+                'text': {
+                    'type': 'mrkdwn',
+                    'text': header_text
+                }
+            },
+        ]
+
+        if thread_info.reply_count > 0:
+            blocks.extend([
                 {
                     'type': 'divider'
-                },
-                {
-                    'type': 'section',
-                    'text': {
-                        'type': 'mrkdwn',
-                        'text': '<%s|元スレッドのリンク(%d)>   #%s' % (thread_info.thread_url, thread_info.reply_count, thread_info.channel_name)
-                    }
-                },
-                {
-                    'type': 'section',
-                    'expand': True,
-                    'text': {
-                        'type': 'mrkdwn',
-                        'text': header_text
-                    }
-                },
-            ]
- 
-            if thread_info.reply_count > 0:
-                blocks.extend([
-                    {
-                        'type': 'divider'
-                    }
-                ])
+                }
+            ])
 
-            response= self.slack_api.post_message(slack_channel, text=title_text+header_text, blocks=blocks, parent_response=response)
+        response= self.slack_api.post_message(slack_channel, text=title_text+header_text, blocks=blocks, parent_response=response)
 
-            if thread_info.reply_count > 0:
-                response= self.slack_api.post_message(slack_channel, text=None, blocks=None, markdown_text=thread_info.summary, parent_response=response)
+        if thread_info.reply_count > 0:
+            response= self.slack_api.post_message(slack_channel, text=None, blocks=None, markdown_text=thread_info.summary, parent_response=response)
+        return  response
 
+    def output_slack_v1(self, slack_channel, summary_list):
+        sink= SlackSink(self, slack_channel)
+        for thread_info in summary_list:
+            sink.add(thread_info)
+        sink.close()
 
     def output_slack_v2(self, slack_channel, summary_list):
         response= self.send_slack_thread(slack_channel, summary_list)
@@ -312,24 +980,142 @@ class SlackSummary:
     def init_slack_api( self ):
         token= self.config.get( 'post_token', self.config.get('token', os.environ.get('SLACK_API_TOKEN')) )
         cache= self.config.get( 'post_cache_file', self.config.get('cache_file', 'cache.json') )
-        self.slack_api= SlackAPI.SlackAPI( token, cache )
+        self.slack_api= SlackAPI.SlackAPI( token, cache, base_url=self.config.get('slack_api_url', None), metrics=self.metrics, rate_scale=self.config.get('slack_rate_scale', 1.0) )
 
-    def output_all(self, summary_list):
-        # 全ての出力を行う
+    def create_sinks(self):
+        sink_list= []
         if self.output_markdown is not None:
-            self.output_md(self.output_markdown, summary_list)
+            sink_list.append(MarkdownSink(self, self.output_markdown))
         if self.output_channel is not None:
             self.init_slack_api()
-            try:
-                self.output_slack_v1(self.output_channel, summary_list)
-            finally:
-                self.slack_api.save_cache()
+            sink_list.append(SlackSink(self, self.output_channel))
+        return  sink_list
+
+    def close_sinks(self):
+        if self.slack_api is not None:
+            self.slack_api.save_cache()
+
+    def output_all(self, summary_list):
+        # 全ての出力を行う
+        sink_list= self.create_sinks()
+        try:
+            for thread_info in summary_list:
+                for sink in sink_list:
+                    sink.add(thread_info)
+            if self.channel_digest:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.llm_concurrency) as executor:
+                    self.finish_digests([self.start_digest(executor, thread_list) for thread_list in self.group_channels(summary_list)])
+            for sink in sink_list:
+                sink.close()
+        finally:
+            self.close_sinks()
+
+    def run(self, sink_list=[]):
+        # 取得・要約・出力をパイプラインで実行する
+        #  sink_list: 設定による出力の前に追加する sink (ベンチマークの計測用など)
+        start_time= time.perf_counter()
+        sink_list= list(sink_list) + self.create_sinks()
+        try:
+            summary_list= self.run_pipeline(self.iter_recent_messages(), sink_list)
+            if self.journal:
+                self.journal.finish()
+        finally:
+            self.close_sinks()
+            if self.journal:
+                self.journal.close()
+            self.ollama_api.close()
+        self.save_metrics(summary_list, time.perf_counter() - start_time)
+        return  summary_list
+
+#------------------------------------------------------------------------------
+
+class MarkdownSink:
+    # 完成したスレッドから順に Markdown を組み立て、最後に見つかった順に並べてヘッダを付けて書き出す
+    def __init__(self, summary, output_file):
+        self.summary= summary
+        self.output_file= output_file
+        self.summary_list= []
+        self.text_list= []
+
+    def add(self, thread_info):
+        self.summary_list.append(thread_info)
+        self.text_list.append(self.summary.get_md_thread(thread_info))
+
+    def close(self):
+        # --load で読み込んだ古い summary.json には index がないのでそのままの順にする
+        order_list= sorted(range(len(self.summary_list)), key=lambda i: getattr(self.summary_list[i], 'index', 0))
+        with open(self.output_file, 'w', encoding='utf-8') as fo:
+            fo.write(self.summary.get_md_header([self.summary_list[i] for i in order_list]))
+            for i in order_list:
+                fo.write(self.text_list[i])
+            fo.write( '\n' )
+
+
+class SlackSink:
+    # 最初のスレッドが完成した時点で親メッセージを投稿し、以降は順にスレッドへ追記する
+    #  投稿は checkpoint に記録し、--resume では投稿済みの親メッセージとスレッドを使い回す
+    def __init__(self, summary, slack_channel):
+        self.summary= summary
+        self.slack_channel= slack_channel
+        self.summary_list= []
+        self.parent_response= None
+        self.parent_resumed= False
+        self.response= None
+
+    def get_posted(self, channel_id=None, ts=None):
+        if self.summary.journal is None:
+            return  None
+        response_ts= self.summary.journal.get_posted(self.slack_channel, channel_id, ts)
+        if response_ts is None:
+            return  None
+        return  {'ts': response_ts}
+
+    def add_posted(self, response, channel_id=None, ts=None):
+        if self.summary.journal is not None and response is not None:
+            self.summary.journal.add_posted(self.slack_channel, channel_id, ts, response.get('ts', None))
+
+    def send_parent(self):
+        # 前回投稿した親メッセージがあれば最後に更新する
+        self.parent_response= self.get_posted()
+        self.parent_resumed= self.parent_response is not None
+        if self.parent_response is None:
+            self.parent_response= self.summary.send_slack_thread(self.slack_channel, self.summary_list)
+            self.add_posted(self.parent_response)
+
+    def add(self, thread_info):
+        self.summary_list.append(thread_info)
+        if self.parent_response is None:
+            self.send_parent()
+            if self.parent_response is None:
+                return
+            self.response= self.parent_response
+        # --load で読み込んだ古い summary.json には thread_ts がない
+        thread_ts= getattr(thread_info, 'thread_ts', None)
+        response= self.get_posted(thread_info.channel_id, thread_ts)
+        if response is None:
+            response= self.summary.post_slack_thread_v1(self.slack_channel, thread_info, self.response)
+            self.add_posted(response, thread_info.channel_id, thread_ts)
+        self.response= response
+
+    def close(self):
+        if self.parent_response is None and (self.summary.failed_list or self.summary.deferred_list):
+            # 全て失敗した場合も失敗一覧を投稿する
+            self.send_parent()
+            if not self.parent_resumed:
+                return
+        if self.parent_response is not None and (self.parent_resumed or len(self.summary_list) > 1 or self.summary.digest_map or self.summary.failed_list or self.summary.deferred_list):
+            self.summary.update_slack_thread(self.slack_channel, self.parent_response, self.summary_list)
 
 #------------------------------------------------------------------------------
 
 def usage():
     print( 'SlackSummary v1.20' )
     print( 'Usage: python SlackSummary.py --config <config_file>' )
+    print( 'options:' )
+    print( '  --save          save summary.json' )
+    print( '  --load          output summary.json without fetching' )
+    print( '  --offline       read messages from archive_file only' )
+    print( '  --resume        continue the interrupted run from checkpoint_file' )
     sys.exit( 1 )
 
 
@@ -337,6 +1123,8 @@ def main(argv):
     config_file= 'config.json'
     save_messages= False
     load_messages= False
+    offline= False
+    resume= False
     acount= len(argv)
     ai= 1
     while ai< acount:
@@ -349,11 +1137,15 @@ def main(argv):
             save_messages= True
         elif arg == '--load':
             load_messages= True
+        elif arg == '--offline':
+            offline= True
+        elif arg == '--resume':
+            resume= True
         else:
             usage()
         ai+= 1
 
-    summary= SlackSummary(config_file)
+    summary= SlackSummary(config_file, offline, resume)
     if load_messages:
         object_list= SlackMessageChecker.SlackAPI.load_json('summary.json')
         summary_list= []
@@ -362,19 +1154,17 @@ def main(argv):
             thread_info.__dict__.update(object)
             summary_list.append(thread_info)
     else:
-        messages = summary.get_recent_messages()
-        if messages is None:
-            return 0
-        summary_list= summary.summarize_messages(messages)
-        if summary_list is None:
-            return 1
+        summary_list= summary.run()
         if save_messages:
             object_list= []
             for thread_info in summary_list:
                 object_list.append(thread_info.__dict__)
             SlackMessageChecker.SlackAPI.save_json('summary.json',object_list)
+        summary.print_stats()
+        return 0
 
     summary.output_all(summary_list)
+    summary.print_stats()
     return 0
 
 
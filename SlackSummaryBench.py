@@ -0,0 +1,593 @@
+# vim:ts=4 sw=4 et:
+#
+# SlackSummary のベンチマーク
+#  Slack Web API と Ollama の代わりになるサーバーをローカルに立て、
+#  合成したワークスペースに対して SlackSummary を最後まで実行して処理量を測る
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import tempfile
+import threading
+import contextlib
+import collections
+import http.server
+import urllib.parse
+
+lib_path= os.path.dirname(os.path.abspath(__file__))
+if lib_path not in sys.path:
+    sys.path.append( lib_path )
+import SlackAPI
+import SlackSummary
+
+#------------------------------------------------------------------------------
+
+class Workspace:
+    # 合成したワークスペース
+    #  channels 個のチャンネルにそれぞれ threads 個のスレッドを作る
+    #  リプライ数は平均 replies の幾何分布、本文の長さは平均 message_chars の対数正規分布
+    def __init__(self, channels=4, threads=50, replies=5.0, message_chars=200, users=50, specified_days=30, seed=1):
+        self.random= random.Random(seed)
+        self.message_chars= message_chars
+        self.now= time.time()
+        self.user_list= [{'id': 'U%05d' % i, 'name': 'user%d' % i, 'real_name': 'User %d' % i, 'profile': {'display_name': 'u%d' % i}} for i in range(users)]
+        self.channel_list= [{'id': 'C%05d' % i, 'name': 'bench-%d' % i} for i in range(channels)]
+        self.message_map= {}
+        self.reply_map= {}
+        for channel in self.channel_list:
+            message_list= []
+            for thread_index in range(threads):
+                parent= self.make_message(self.now - self.random.uniform(0, specified_days * 24*60*60))
+                reply_count= self.get_reply_count(replies)
+                if reply_count > 0:
+                    reply_list= []
+                    parent_ts= float(parent['ts'])
+                    for reply_index in range(reply_count):
+                        reply= self.make_message(self.random.uniform(parent_ts, self.now))
+                        reply['thread_ts']= parent['ts']
+                        reply_list.append(reply)
+                    reply_list.sort(key=lambda message: float(message['ts']))
+                    user_set= []
+                    for reply in reply_list:
+                        if reply['user'] not in user_set:
+                            user_set.append(reply['user'])
+                    parent.update(thread_ts=parent['ts'], reply_count=reply_count, reply_users=user_set,
+                            reply_users_count=len(user_set), latest_reply=reply_list[-1]['ts'])
+                    self.reply_map[(channel['id'], parent['ts'])]= reply_list
+                message_list.append(parent)
+            message_list.sort(key=lambda message: float(message['ts']), reverse=True)
+            self.message_map[channel['id']]= message_list
+
+    def get_reply_count(self, mean):
+        if mean <= 0:
+            return  0
+        count= 0
+        while self.random.random() < mean / (mean + 1.0):
+            count+= 1
+        return  count
+
+    def make_message(self, ts):
+        length= max(1, int(self.random.lognormvariate(0, 0.8) * self.message_chars))
+        words= ['slack', 'summary', 'build', 'release', 'review', 'deploy', 'error', 'fix', 'test', 'memo', 'レビュー', '確認', '対応', '修正']
+        text= ''
+        while len(text) < length:
+            text+= self.random.choice(words) + ' '
+        return  {'type': 'message', 'user': self.random.choice(self.user_list)['id'], 'text': text[:length], 'ts': '%.6f' % ts}
+
+    def get_stats_text(self):
+        thread_count= sum(len(message_list) for message_list in self.message_map.values())
+        reply_count= sum(len(reply_list) for reply_list in self.reply_map.values())
+        return  'channels=%d threads=%d replies=%d users=%d' % (len(self.channel_list), thread_count, reply_count, len(self.user_list))
+
+#------------------------------------------------------------------------------
+
+class ServerBucket:
+    # サーバー側の rate limit  空いていなければ待ち時間を返す
+    def __init__(self, rate_per_min, burst):
+        self.rate= rate_per_min / 60.0
+        self.capacity= float(burst)
+        self.tokens= float(burst)
+        self.last_time= time.monotonic()
+        self.lock= threading.Lock()
+
+    def try_acquire(self):
+        with self.lock:
+            now= time.monotonic()
+            self.tokens= min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time= now
+            if self.tokens >= 1.0:
+                self.tokens-= 1.0
+                return  0.0
+            return  (1.0 - self.tokens) / self.rate
+
+
+class BenchServer:
+    # ThreadingHTTPServer で handle_request( method, path, params ) を呼ぶ
+    def __init__(self):
+        self.call_count= collections.Counter()
+        self.lock= threading.Lock()
+        self.server= None
+
+    def start(self):
+        bench= self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version= 'HTTP/1.1'
+            def do_GET(self):
+                self.dispatch()
+            def do_POST(self):
+                self.dispatch()
+            def dispatch(self):
+                url= urllib.parse.urlparse(self.path)
+                params= dict(urllib.parse.parse_qsl(url.query))
+                length= int(self.headers.get('Content-Length', 0))
+                body= self.rfile.read(length) if length else b''
+                if body:
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(dict(urllib.parse.parse_qsl(body.decode('utf-8'))))
+                bench.handle_request(self, url.path, params)
+            def log_message(self, *args):
+                pass
+        self.server= http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads= True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return  'http://127.0.0.1:%d' % self.server.server_port
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server= None
+
+    def count(self, name):
+        with self.lock:
+            self.call_count[name]+= 1
+
+    def send_json(self, handler, status, data, headers={}):
+        body= json.dumps(data, ensure_ascii=False).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for key in headers:
+            handler.send_header(key, headers[key])
+        handler.end_headers()
+        handler.wfile.write(body)
+
+#------------------------------------------------------------------------------
+
+class FakeSlackServer(BenchServer):
+    # Slack Web API の代わり
+    #  latency: 1 回の呼び出しにかかる秒数
+    #  rate_scale: Slack の tier ごとの rate limit に掛ける倍率 (0 で制限なし)  超えると 429 + Retry-After
+    #  error_rate: 制限に関係なく 429 を返す確率
+    def __init__(self, workspace, latency=0.0, rate_scale=0.0, error_rate=0.0):
+        super().__init__()
+        self.workspace= workspace
+        self.latency= latency
+        self.rate_scale= rate_scale
+        self.error_rate= error_rate
+        self.tier_map= SlackAPI.SlackRateLimiter.TIER_MAP
+        self.bucket_map= {}
+        self.post_count= 0
+        self.random= random.Random(2)
+
+    def get_bucket(self, method):
+        with self.lock:
+            bucket= self.bucket_map.get(method, None)
+            if bucket is None:
+                tier= SlackAPI.SlackRateLimiter.METHOD_TIER_MAP.get(method.replace('.', '_'), SlackAPI.SlackRateLimiter.DEFAULT_TIER)
+                rate_per_min,burst= self.tier_map[tier]
+                bucket= ServerBucket(rate_per_min * self.rate_scale, burst)
+                self.bucket_map[method]= bucket
+            return  bucket
+
+    def handle_request(self, handler, path, params):
+        method= path.rsplit('/', 1)[-1]
+        self.count(method)
+        if self.latency > 0.0:
+            time.sleep(self.latency)
+        if self.rate_scale > 0.0:
+            wait_time= self.get_bucket(method).try_acquire()
+            if wait_time > 0.0:
+                self.count('429')
+                self.send_json(handler, 429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': str(max(1, int(wait_time + 0.999)))})
+                return
+        with self.lock:
+            error= self.random.random() < self.error_rate
+        if error:
+            self.count('429')
+            self.send_json(handler, 429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': '1'})
+            return
+        func= getattr(self, 'api_' + method.replace('.', '_'), None)
+        if func is None:
+            self.send_json(handler, 200, {'ok': False, 'error': 'unknown_method'})
+            return
+        # ok: False を返したもの (user_not_found など) はそのまま返す
+        result= {'ok': True}
+        result.update(func(params))
+        self.send_json(handler, 200, result)
+
+    def get_page(self, item_list, params, default_limit=100):
+        # cursor はリストの位置
+        start= int(params.get('cursor', '') or 0)
+        limit= int(params.get('limit', default_limit) or default_limit)
+        page= item_list[start:start+limit]
+        next_cursor= ''
+        if start + limit < len(item_list):
+            next_cursor= str(start + limit)
+        return  page,{'next_cursor': next_cursor}
+
+    def api_auth_test(self, params):
+        return  {'url': 'https://bench.slack.com/', 'team': 'bench', 'team_id': 'T00000'}
+
+    def api_conversations_list(self, params):
+        page,metadata= self.get_page(self.workspace.channel_list, params, 800)
+        return  {'channels': page, 'response_metadata': metadata}
+
+    def api_users_list(self, params):
+        page,metadata= self.get_page(self.workspace.user_list, params, 200)
+        return  {'members': page, 'response_metadata': metadata}
+
+    def api_users_info(self, params):
+        for user in self.workspace.user_list:
+            if user['id'] == params.get('user'):
+                return  {'user': user}
+        return  {'ok': False, 'error': 'user_not_found'}
+
+    def api_conversations_history(self, params):
+        oldest= float(params.get('oldest', 0) or 0)
+        latest= float(params.get('latest', 0) or 0)
+        message_list= [message for message in self.workspace.message_map.get(params.get('channel'), [])
+                if float(message['ts']) >= oldest and (latest == 0 or float(message['ts']) < latest)]
+        page,metadata= self.get_page(message_list, params)
+        return  {'messages': page, 'has_more': metadata['next_cursor'] != '', 'response_metadata': metadata}
+
+    def api_conversations_replies(self, params):
+        channel_id= params.get('channel')
+        ts= params.get('ts')
+        parent= None
+        for message in self.workspace.message_map.get(channel_id, []):
+            if message['ts'] == ts:
+                parent= message
+                break
+        if parent is None:
+            return  {'ok': False, 'error': 'thread_not_found'}
+        oldest= float(params.get('oldest', 0) or 0)
+        reply_list= [reply for reply in self.workspace.reply_map.get((channel_id, ts), []) if float(reply['ts']) > oldest]
+        page,metadata= self.get_page([parent] + reply_list, params, 1000)
+        return  {'messages': page, 'has_more': metadata['next_cursor'] != '', 'response_metadata': metadata}
+
+    def api_chat_getPermalink(self, params):
+        return  {'permalink': 'https://bench.slack.com/archives/%s/p%s' % (params.get('channel'), params.get('message_ts', '').replace('.', ''))}
+
+    def api_chat_postMessage(self, params):
+        with self.lock:
+            self.post_count+= 1
+            ts= '%d.%06d' % (int(time.time()), self.post_count)
+        return  {'channel': params.get('channel'), 'ts': ts}
+
+    def api_chat_update(self, params):
+        return  {'channel': params.get('channel'), 'ts': params.get('ts')}
+
+#------------------------------------------------------------------------------
+
+class FakeOllamaServer(BenchServer):
+    # Ollama (/api/chat, /api/generate) と OpenAI 互換 API (/v1/chat/completions) の代わり
+    #  入力 token を prompt_rate [token/s]、出力 output_tokens を eval_rate [token/s] で処理したのと同じだけ待つ
+    #  parallel 件まで同時に処理し、待ちが max_queue 件を超えると 429 を返す
+    #  error_rate: 503 を返す確率
+    def __init__(self, prompt_rate=2000.0, eval_rate=50.0, output_tokens=100, parallel=1, max_queue=64, latency=0.0, error_rate=0.0):
+        super().__init__()
+        self.prompt_rate= prompt_rate
+        self.eval_rate= eval_rate
+        self.output_tokens= output_tokens
+        self.parallel= threading.Semaphore(parallel)
+        self.max_queue= max_queue
+        self.latency= latency
+        self.error_rate= error_rate
+        self.waiting= 0
+        self.prompt_tokens_total= 0
+        self.eval_tokens_total= 0
+        self.busy_time= 0.0
+        self.random= random.Random(3)
+
+    def handle_request(self, handler, path, params):
+        self.count(path)
+        if path == '/api/version':
+            self.send_json(handler, 200, {'version': 'bench'})
+            return
+        if path == '/v1/models':
+            self.send_json(handler, 200, {'data': [{'id': 'bench'}]})
+            return
+        if path == '/api/generate' and params.get('prompt', None) is None:
+            # preload
+            self.send_json(handler, 200, {'model': params.get('model', ''), 'response': '', 'done': True})
+            return
+        with self.lock:
+            error= self.random.random() < self.error_rate
+            full= self.waiting >= self.max_queue
+            if not error and not full:
+                self.waiting+= 1
+        if error:
+            self.count('503')
+            self.send_json(handler, 503, {'error': 'bench error'})
+            return
+        if full:
+            self.count('429')
+            self.send_json(handler, 429, {'error': 'server busy'})
+            return
+        try:
+            with self.parallel:
+                with self.lock:
+                    self.waiting-= 1
+                self.generate(handler, path, params)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def get_prompt(self, params):
+        if 'messages' in params:
+            return  '\n'.join(str(message.get('content', '')) for message in params['messages'])
+        return  str(params.get('system', '')) + '\n' + str(params.get('prompt', ''))
+
+    def get_output(self, params, output_tokens):
+        text= ('summary ' * output_tokens)[:output_tokens * 4]
+        if params.get('format', None) or params.get('response_format', None):
+            text= json.dumps({'summary': text, 'header': 'bench header'})
+        return  text
+
+    def generate(self, handler, path, params):
+        start_time= time.perf_counter()
+        prompt_tokens= len(self.get_prompt(params).encode('utf-8')) // 3 + 1
+        output_tokens= max(1, int(self.random.uniform(0.5, 1.5) * self.output_tokens))
+        prompt_time= self.latency + prompt_tokens / self.prompt_rate
+        eval_time= output_tokens / self.eval_rate
+        output= self.get_output(params, output_tokens)
+        time.sleep(prompt_time)
+        stats= {
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(prompt_time * 1e9),
+            'eval_count': output_tokens,
+            'eval_duration': int(eval_time * 1e9),
+        }
+        if path == '/v1/chat/completions':
+            time.sleep(eval_time)
+            self.send_json(handler, 200, {'choices': [{'message': {'role': 'assistant', 'content': output}}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': output_tokens}})
+        elif params.get('stream', False):
+            # 10 回に分けて送る
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/x-ndjson')
+            handler.send_header('Transfer-Encoding', 'chunked')
+            handler.end_headers()
+            step= max(1, len(output) // 10)
+            for pos in range(0, len(output), step):
+                time.sleep(eval_time * step / len(output))
+                self.send_chunk(handler, {'message': {'role': 'assistant', 'content': output[pos:pos+step]}, 'done': False})
+            self.send_chunk(handler, dict(stats, message={'role': 'assistant', 'content': ''}, done=True))
+            handler.wfile.write(b'0\r\n\r\n')
+        else:
+            time.sleep(eval_time)
+            if path == '/api/generate':
+                self.send_json(handler, 200, dict(stats, response=output, done=True))
+            else:
+                self.send_json(handler, 200, dict(stats, message={'role': 'assistant', 'content': output}, done=True))
+        with self.lock:
+            self.prompt_tokens_total+= prompt_tokens
+            self.eval_tokens_total+= output_tokens
+            self.busy_time+= time.perf_counter() - start_time
+
+    def send_chunk(self, handler, data):
+        body= (json.dumps(data) + '\n').encode('utf-8')
+        handler.wfile.write(b'%x\r\n%s\r\n' % (len(body), body))
+        handler.wfile.flush()
+
+#------------------------------------------------------------------------------
+
+class BenchSink:
+    # 要約の完了時刻と出力の開始時刻を記録する (他の sink より先に置く)
+    def __init__(self, start_time):
+        self.start_time= start_time
+        self.time_list= []
+        self.close_time= None
+
+    def add(self, thread_info):
+        self.time_list.append(time.perf_counter() - self.start_time)
+
+    def close(self):
+        self.close_time= time.perf_counter() - self.start_time
+
+
+def run_summary(config_file, verbose):
+    # SlackSummary.run をそのまま実行し、BenchSink で段階ごとの時刻を記録する
+    output= io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        summary= SlackSummary.SlackSummary(config_file)
+        start_time= time.perf_counter()
+        bench_sink= BenchSink(start_time)
+        summary_list= summary.run([bench_sink])
+        total_time= time.perf_counter() - start_time
+    time_list= bench_sink.time_list
+    return  {
+        'threads': len(summary_list),
+        'failed': len(summary.failed_list),
+        'total_time': total_time,
+        'crawl_time': summary.metrics.get('fetch_seconds'),
+        'first_result_time': time_list[0] if time_list else None,
+        'summarize_time': time_list[-1] if time_list else None,
+        'publish_time': total_time - bench_sink.close_time,
+        'threads_per_minute': len(summary_list) * 60.0 / total_time if total_time > 0 else 0.0,
+        'stages': summary.metrics.get_stage_text(),
+        'metrics': summary.metrics.get_report(),
+    }
+
+#------------------------------------------------------------------------------
+
+class BenchOptions(SlackSummary.OllamaAPI4.OptionBase):
+    def __init__(self):
+        super().__init__()
+        self.channels= 4
+        self.threads= 50
+        self.replies= 5.0
+        self.message_chars= 200
+        self.users= 50
+        self.recent_days= 3
+        self.specified_days= 30
+        self.slack_latency= 0.01
+        self.slack_rate_scale= 0.0
+        self.slack_error_rate= 0.0
+        self.client_rate_scale= 1.0
+        self.ollama_hosts= 1
+        self.prompt_rate= 2000.0
+        self.eval_rate= 50.0
+        self.output_tokens= 100
+        self.ollama_parallel= 1
+        self.ollama_latency= 0.0
+        self.ollama_error_rate= 0.0
+        self.runs= 1
+        self.config= None
+        self.output= None
+        self.post= False
+        self.verbose= False
+
+
+def run_benchmark(options):
+    workspace= Workspace(options.channels, options.threads, options.replies, options.message_chars, options.users, options.specified_days)
+    slack_server= FakeSlackServer(workspace, options.slack_latency, options.slack_rate_scale, options.slack_error_rate)
+    ollama_list= [FakeOllamaServer(options.prompt_rate, options.eval_rate, options.output_tokens, options.ollama_parallel, latency=options.ollama_latency, error_rate=options.ollama_error_rate) for i in range(options.ollama_hosts)]
+    report= {'workspace': workspace.get_stats_text(), 'runs': []}
+    current_dir= os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            slack_url= slack_server.start()
+            ollama_url_list= [server.start() for server in ollama_list]
+            config= {
+                'token': 'xoxb-bench',
+                'slack_api_url': slack_url + '/api/',
+                'recent_days': options.recent_days,
+                'specified_days': options.specified_days,
+                'target_channels': [channel['name'] for channel in workspace.channel_list],
+                'cache_file': 'cache.db',
+                'archive_file': 'archive.db',
+                'summary_cache_file': 'summary_cache.json',
+                'metrics_file': 'metrics.json',
+                'metrics_prom_file': 'metrics.prom',
+                'output_markdown': 'output.md',
+                'system_prompt': '以下はslackの一連のスレッドを取り出したものです。スレッド全体を要約してください。',
+                'header_prompt': '数行で簡潔にまとめて。',
+                'provider': 'ollama',
+                'ollama_host': ollama_url_list,
+                'model_name': 'bench',
+                'fetch_concurrency': 4,
+                'llm_concurrency': options.ollama_hosts * options.ollama_parallel,
+                # クライアント側の rate limit も合わせて変えられるようにする (サーバー側は元の値を基準にする)
+                'slack_rate_scale': options.client_rate_scale,
+            }
+            if options.post:
+                config['output_channel']= workspace.channel_list[0]['name']
+            if options.config:
+                config.update(SlackAPI.load_json(options.config))
+            os.chdir(work_dir)
+            SlackAPI.save_json('config.json', config)
+            for run_index in range(options.runs):
+                slack_server.call_count.clear()
+                for server in ollama_list:
+                    server.call_count.clear()
+                result= run_summary('config.json', options.verbose)
+                result['slack_calls']= dict(slack_server.call_count)
+                result['ollama_calls']= dict(sum((server.call_count for server in ollama_list), collections.Counter()))
+                result['ollama_prompt_tokens']= sum(server.prompt_tokens_total for server in ollama_list)
+                result['ollama_eval_tokens']= sum(server.eval_tokens_total for server in ollama_list)
+                result['ollama_busy_time']= sum(server.busy_time for server in ollama_list)
+                for server in ollama_list:
+                    server.prompt_tokens_total= 0
+                    server.eval_tokens_total= 0
+                    server.busy_time= 0.0
+                report['runs'].append(result)
+        finally:
+            os.chdir(current_dir)
+            slack_server.stop()
+            for server in ollama_list:
+                server.stop()
+    return  report
+
+
+def print_report(report):
+    print('workspace: %s' % report['workspace'])
+    for run_index,result in enumerate(report['runs']):
+        def get_time(key):
+            return  '-' if result[key] is None else '%.2f sec' % result[key]
+        print('run %d:' % (run_index + 1))
+        print('  threads:         %d (failed %d)' % (result['threads'], result['failed']))
+        print('  threads/minute:  %.1f' % result['threads_per_minute'])
+        print('  total:           %s' % get_time('total_time'))
+        print('  crawl:           %s' % get_time('crawl_time'))
+        print('  first result:    %s' % get_time('first_result_time'))
+        print('  summarize:       %s' % get_time('summarize_time'))
+        print('  publish:         %s' % get_time('publish_time'))
+        print('  slack calls:     %s' % ', '.join('%s=%d' % (key, value) for key,value in sorted(result['slack_calls'].items())))
+        print('  ollama calls:    %s' % ', '.join('%s=%d' % (key, value) for key,value in sorted(result['ollama_calls'].items())))
+        print('  ollama tokens:   prompt=%d eval=%d busy=%.2f sec' % (result['ollama_prompt_tokens'], result['ollama_eval_tokens'], result['ollama_busy_time']))
+        print('  stages:')
+        print(result['stages'].replace('  ', '    '), end='')
+
+
+def usage():
+    print('SlackSummaryBench')
+    print('usage: python SlackSummaryBench.py [<options>]')
+    print('options:')
+    print('  --channels <n>             default 4')
+    print('  --threads <n>              threads per channel, default 50')
+    print('  --replies <n>              average replies per thread, default 5')
+    print('  --message_chars <n>        average message length, default 200')
+    print('  --recent_days <n>          default 3')
+    print('  --slack_latency <sec>      default 0.01')
+    print('  --slack_rate_scale <x>     scale of Slack tier rate limits (0: unlimited)')
+    print('  --slack_error_rate <p>     probability of 429')
+    print('  --client_rate_scale <x>    scale of SlackAPI client rate limits, default 1')
+    print('  --ollama_hosts <n>         default 1')
+    print('  --ollama_parallel <n>      requests per host, default 1')
+    print('  --prompt_rate <tok/s>      default 2000')
+    print('  --eval_rate <tok/s>        default 50')
+    print('  --output_tokens <n>        default 100')
+    print('  --ollama_latency <sec>')
+    print('  --ollama_error_rate <p>    probability of 503')
+    print('  --runs <n>                 repeat with the same caches and archive, default 1')
+    print('  --config <config.json>     override SlackSummary config')
+    print('  --output <report.json>')
+    print('  --post                     post the summary to the fake Slack')
+    print('  --verbose')
+    sys.exit(1)
+
+
+def main(argv):
+    options= BenchOptions()
+    acount= len(argv)
+    ai= 1
+    while ai < acount:
+        arg= argv[ai]
+        if arg in ('--channels', '--threads', '--message_chars', '--recent_days', '--ollama_hosts', '--ollama_parallel', '--output_tokens', '--runs'):
+            ai= options.set_int(ai, argv, arg[2:])
+        elif arg in ('--replies', '--slack_latency', '--slack_rate_scale', '--slack_error_rate', '--client_rate_scale', '--prompt_rate', '--eval_rate', '--ollama_latency', '--ollama_error_rate'):
+            ai= options.set_float(ai, argv, arg[2:])
+        elif arg in ('--config', '--output'):
+            ai= options.set_str(ai, argv, arg[2:])
+        elif arg == '--post':
+            options.post= True
+        elif arg == '--verbose':
+            options.verbose= True
+        else:
+            usage()
+        ai+= 1
+    report= run_benchmark(options)
+    print_report(report)
+    if options.output:
+        SlackAPI.save_json(options.output, report)
+    return  0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
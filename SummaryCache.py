@@ -0,0 +1,80 @@
+# vim:ts=4 sw=4 et:
+
+import os
+import sys
+import time
+import json
+import hashlib
+
+lib_path= os.path.dirname(__file__)
+if lib_path not in sys.path:
+    sys.path.append( lib_path )
+import SlackAPI
+
+#-------------------------------------------------------------------------------
+
+class SummaryCache:
+    CACHE_VERSION=1
+
+    def __init__( self, cache_file, max_entries=5000, max_days=30 ):
+        self.cache_file= cache_file
+        self.max_entries= max_entries
+        self.max_days= max_days
+        self.entry_map= {}
+        self.hit_count= 0
+        self.miss_count= 0
+        self.cache_updated= False
+        self.load_cache()
+
+    def load_cache( self ):
+        cache= SlackAPI.load_json( self.cache_file )
+        if cache:
+            print( 'load', self.cache_file, flush=True )
+            if cache.get( 'version', 0 ) == self.CACHE_VERSION:
+                self.entry_map= cache.get( 'entry', {} )
+        self.evict()
+
+    def save_cache( self ):
+        if self.cache_updated:
+            self.evict()
+            SlackAPI.save_json( self.cache_file, {'entry':self.entry_map, 'version':self.CACHE_VERSION} )
+            self.cache_updated= False
+            print( 'save', self.cache_file, flush=True )
+
+    #--------------------------------------------------------------------------
+
+    def make_key( self, *key_list ):
+        data= json.dumps( key_list, ensure_ascii=False, sort_keys=True )
+        return  hashlib.sha256( data.encode( 'utf-8' ) ).hexdigest()
+
+    def get( self, key ):
+        entry= self.entry_map.get( key, None )
+        if entry is None or entry['time'] < time.time() - self.max_days * 24*60*60:
+            self.miss_count+= 1
+            return  None
+        entry['time']= time.time()
+        self.cache_updated= True
+        self.hit_count+= 1
+        return  entry['value']
+
+    def set( self, key, value ):
+        self.entry_map[key]= { 'value': value, 'time': time.time() }
+        self.cache_updated= True
+
+    def evict( self ):
+        # 期限切れのエントリを削除し、古いものから上限数まで削る
+        limit_time= time.time() - self.max_days * 24*60*60
+        key_list= [key for key in self.entry_map if self.entry_map[key]['time'] >= limit_time]
+        key_list.sort( key=lambda key: self.entry_map[key]['time'], reverse=True )
+        key_list= key_list[:self.max_entries]
+        if len(key_list) != len(self.entry_map):
+            self.entry_map= { key: self.entry_map[key] for key in key_list }
+            self.cache_updated= True
+
+    def get_stats_text( self ):
+        total= self.hit_count + self.miss_count
+        rate= 0.0
+        if total != 0:
+            rate= self.hit_count * 100.0 / total
+        return  'hit=%d miss=%d (%.1f%%) entries=%d' % (self.hit_count, self.miss_count, rate, len(self.entry_map))
+
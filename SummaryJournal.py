@@ -0,0 +1,128 @@
+# vim:ts=4 sw=4 et:
+
+import os
+import json
+import threading
+
+#-------------------------------------------------------------------------------
+
+class SummaryJournal:
+    # 要約の済んだスレッドを 1 件ずつ追記する (途中で止まっても --resume で再開できる)
+    #  1 行目は実行情報 (期間の基準日時と設定)、以降は 1 行 1 スレッドか投稿済みの記録
+    #  最後まで終わった場合は完了の記録を書き、--resume でも同じ期間を繰り返さない
+    JOURNAL_VERSION=1
+
+    def __init__( self, journal_file ):
+        self.journal_file= journal_file
+        self.run_info= None
+        self.thread_map= {}
+        self.posted_map= {}
+        self.finished= False
+        self.valid_size= 0
+        self.fo= None
+        self.lock= threading.Lock()
+
+    def load( self ):
+        self.run_info= None
+        self.thread_map= {}
+        self.posted_map= {}
+        self.finished= False
+        self.valid_size= 0
+        if not os.path.exists( self.journal_file ):
+            return
+        with open( self.journal_file, 'rb' ) as fi:
+            for line in fi:
+                # 書き込み途中で止まった最後の行 (改行まで書かれていない行) は捨てる
+                if not line.endswith( b'\n' ):
+                    break
+                try:
+                    record= json.loads( line.decode( 'utf-8' ) )
+                except ValueError:
+                    break
+                if self.run_info is None:
+                    if record.get( 'version', 0 ) != self.JOURNAL_VERSION:
+                        return
+                    self.run_info= record
+                elif record.get( 'finished', False ):
+                    self.finished= True
+                elif 'posted' in record:
+                    self.posted_map[(record['posted'], record['channel'], record['ts'])]= record['response']
+                else:
+                    self.thread_map[(record['channel'], record['ts'])]= record['thread']
+                self.valid_size+= len(line)
+        print( 'load', self.journal_file, len(self.thread_map), flush=True )
+
+    def is_same_run( self, run_info ):
+        # 基準日時以外の設定が同じなら同じ実行とみなす
+        if self.run_info is None:
+            return  False
+        for key in run_info:
+            if key != 'today' and self.run_info.get( key, None ) != run_info[key]:
+                return  False
+        return  True
+
+    def start( self, run_info, resume ):
+        # resume で前回と同じ実行なら追記、それ以外は作り直す
+        #  return: 期間の基準日時 (time.time() 形式)
+        if resume:
+            self.load()
+            if self.finished:
+                print( 'checkpoint is already finished, start over', flush=True )
+            elif self.is_same_run( run_info ):
+                print( 'resume %d threads' % len(self.thread_map), flush=True )
+                # 壊れた最後の行の続きに追記しないように切り詰める
+                os.truncate( self.journal_file, self.valid_size )
+                self.fo= open( self.journal_file, 'a', encoding='utf-8' )
+                return  self.run_info['today']
+            else:
+                print( 'checkpoint does not match, start over', flush=True )
+        self.run_info= dict( run_info, version=self.JOURNAL_VERSION )
+        self.thread_map= {}
+        self.posted_map= {}
+        self.finished= False
+        self.fo= open( self.journal_file, 'w', encoding='utf-8' )
+        self.write_record( self.run_info )
+        return  self.run_info['today']
+
+    def finish( self ):
+        # 最後まで終わった
+        with self.lock:
+            self.finished= True
+            if self.fo is not None:
+                self.write_record( { 'finished': True } )
+
+    def close( self ):
+        with self.lock:
+            if self.fo is not None:
+                self.fo.close()
+                self.fo= None
+
+    #--------------------------------------------------------------------------
+
+    def write_record( self, record ):
+        self.fo.write( json.dumps( record, ensure_ascii=False ) + '\n' )
+        self.fo.flush()
+        os.fsync( self.fo.fileno() )
+
+    def get_skip_set( self ):
+        return  set( self.thread_map.keys() )
+
+    def get_thread( self, channel_id, ts ):
+        return  self.thread_map.get( (channel_id, ts), None )
+
+    def add_thread( self, channel_id, ts, thread ):
+        with self.lock:
+            self.thread_map[(channel_id, ts)]= thread
+            if self.fo is not None:
+                self.write_record( { 'channel': channel_id, 'ts': ts, 'thread': thread } )
+
+    def get_posted( self, output, channel_id=None, ts=None ):
+        # 投稿済みなら投稿の ts  channel_id と ts が None なら親メッセージ
+        return  self.posted_map.get( (output, channel_id, ts), None )
+
+    def add_posted( self, output, channel_id, ts, response_ts ):
+        with self.lock:
+            self.posted_map[(output, channel_id, ts)]= response_ts
+            if self.fo is not None:
+                self.write_record( { 'posted': output, 'channel': channel_id, 'ts': ts, 'response': response_ts } )
+
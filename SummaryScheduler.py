@@ -0,0 +1,108 @@
+# vim:ts=4 sw=4 et:
+
+import math
+import time
+import heapq
+import threading
+
+#-------------------------------------------------------------------------------
+
+class SummaryScheduler:
+    # 要約ジョブを優先度順に取り出す
+    #  優先度: チャンネルの重み × (1 + log(1 + リプライ数)) × 最終更新からの経過時間による減衰
+    #  優先度 / 推定 token 数 の大きい順 (重み付き最短ジョブ優先) で取り出し、短いスレッドから結果が出るようにする
+    #  time_budget 秒を過ぎたら、または締め切りまでに終わらない見込みのジョブは取り出さずに deferred にする
+    def __init__( self, time_budget=0, channel_weight=None, half_life_hours=24.0 ):
+        self.time_budget= time_budget
+        self.channel_weight= channel_weight or {}
+        self.half_life_hours= half_life_hours
+        self.start_time= time.monotonic()
+        self.deadline= None
+        if time_budget:
+            self.deadline= self.start_time + time_budget
+        self.heap= []
+        self.sequence= 0
+        self.closed= False
+        self.deferred_list= []
+        self.sec_per_token= None
+        self.condition= threading.Condition()
+
+    def get_priority( self, channel_name, reply_count, latest_ts, now=None ):
+        if now is None:
+            now= time.time()
+        age_hours= max( 0.0, now - latest_ts ) / (60*60)
+        recency= 1.0
+        if self.half_life_hours > 0:
+            recency= 0.5 ** (age_hours / self.half_life_hours)
+        return  self.channel_weight.get( channel_name, 1.0 ) * (1.0 + math.log1p( reply_count )) * recency
+
+    def get_remaining( self ):
+        if self.deadline is None:
+            return  None
+        return  self.deadline - time.monotonic()
+
+    def is_expired( self ):
+        remaining= self.get_remaining()
+        return  remaining is not None and remaining <= 0.0
+
+    def estimate( self, tokens ):
+        # 完了したジョブの 1 token あたりの時間から見積もる  実績がなければ 0
+        if self.sec_per_token is None:
+            return  0.0
+        return  tokens * self.sec_per_token
+
+    def is_feasible( self, tokens ):
+        # 締め切りまでに終わる見込みがあるか
+        remaining= self.get_remaining()
+        return  remaining is None or self.estimate( tokens ) < remaining
+
+    def record( self, tokens, sec ):
+        # 見積もりを更新する (指数移動平均)
+        with self.condition:
+            rate= sec / max( 1, tokens )
+            if self.sec_per_token is None:
+                self.sec_per_token= rate
+            else:
+                self.sec_per_token= self.sec_per_token * 0.7 + rate * 0.3
+
+    #--------------------------------------------------------------------------
+
+    def add( self, job, priority, tokens ):
+        with self.condition:
+            if self.is_expired():
+                self.deferred_list.append( job )
+                return
+            heapq.heappush( self.heap, (-priority / max( 1, tokens ), self.sequence, tokens, job) )
+            self.sequence+= 1
+            self.condition.notify()
+
+    def defer( self, job ):
+        # 要約せずに deferred にする
+        with self.condition:
+            self.deferred_list.append( job )
+
+    def close( self ):
+        # これ以上ジョブを追加しない
+        with self.condition:
+            self.closed= True
+            self.condition.notify_all()
+
+    def pop( self ):
+        # 次のジョブと推定 token 数を返す  全て取り出したか時間切れなら None
+        #  締め切りまでに終わらない見込みのジョブは以降も間に合わないので deferred にする
+        with self.condition:
+            while True:
+                while self.heap != []:
+                    rank,sequence,tokens,job= heapq.heappop( self.heap )
+                    if self.is_feasible( tokens ):
+                        return  job,tokens
+                    self.deferred_list.append( job )
+                if self.closed:
+                    return  None,0
+                self.condition.wait( timeout=1.0 )
+
+    def get_deferred( self ):
+        # 取り出されなかったジョブ  追加された順
+        with self.condition:
+            return  list( self.deferred_list )
+